@@ -1,120 +1,318 @@
 import os
-import src.ontology.create_ontology as create_ontology_file
-import src.global_classifier.find_global as find_global
-import src.global_classifier.train_global as train_global
-import src.dataset.relabel_dataset as relabel_dataset_files
-import src.props.train_prop as train_prop
-import src.props.find_prop as find_prop
-import src.compound_models as compound_models
-import src.reasoning as reasoning
+import argparse
+
+from src.pipeline import run_pipeline
+from src.tasks import PROP_CLASSES, get_checkpoint_path, get_tasks
+
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Same as src.model.model.BACKBONES, which imports torch
+BACKBONES = ("resnet50", "native")
+
+
+def path(*parts):
+    return os.path.join(current_dir, *parts)
 
 
 def check_file_exists(file_path):
     return os.path.exists(file_path)
 
 
-# Step 1: Create Ontology by calling the main function from 'create_ontology.py' if 'ontology.owl' doesn't exist.
+# Each step imports its modules when it runs, so that a single stage, e.g. reasoning, does not import torch.
+
+# Step 1: Create Ontology by calling the main function from 'create_ontology.py'.
 def create_ontology():
-    ontology_file_path = "data/ontology/ontology.owl"
-    if not check_file_exists(ontology_file_path):
-        create_ontology_file.main()
-        print("1 - Create Ontology")
+    import src.ontology.create_ontology as create_ontology_file
+    create_ontology_file.main()
+    print("1 - Create Ontology")
 
 
 # Step 2: Check if Training and Testing Files exist, and provide a warning if missing.
 def check_training_testing_files():
-    train_file_path = "data/csv/train.csv"
-    test_file_path = "data/csv/test.csv"
+    train_file_path = path("data/csv/train.csv")
+    test_file_path = path("data/csv/test.csv")
     if not (check_file_exists(train_file_path) and check_file_exists(test_file_path)):
         print("Warning: Missing training or testing files (train.csv or test.csv)")
     else:
         print("2 - Training and testing files exist.")
 
 
-# Step 3: Train the Global Model if it doesn't exist, and then find the Global Model.
-def train_and_find_global_model():
-    global_model_path = "data/model/global_model.pth"
-    if not check_file_exists(global_model_path):
-        train_global.main()  # Call the main function from 'train_global.py'
-        print("3 - Train Global Model")
-    find_global.main()  # Call the main function from 'find_global.py'
-    print("3 - Find Global Model")
+# Step 3: Prepare the relabeled views of the dataset by calling the main function from 'relabel_dataset.py'.
+# Labels are remapped on the fly during training, so this only builds the shared image store.
+def relabel_dataset():
+    import src.dataset.relabel_dataset as relabel_dataset_files
+    relabel_dataset_files.main()  # Call the main function from 'relabel_dataset.py'
+    print("3 - Relabel Dataset")
 
 
-# Step 4: Relabel the Dataset by calling the main function from 'relabel_dataset.py'
-# if specific dataset files don't exist.
-def relabel_dataset():
-    dataset_paths = [
-        "data/csv/props/straightedges.csv",
-        "data/csv/props/curves.csv",
-        "data/csv/props/buttons.csv",
-        "data/csv/props/sleeves.csv",
-        "data/csv/props/collars.csv"
-    ]
-    if any(not check_file_exists(dataset_path) for dataset_path in dataset_paths):
-        relabel_dataset_files.main()  # Call the main function from 'relabel_dataset.py'
-        print("4 - Relabel Dataset")
-
-
-# Step 5: Train Prop Models if specific model files don't exist, and then find Prop Models.
-def train_and_find_prop_models():
-    model_paths = [
-        "data/model/straightedges_model.pth",
-        "data/model/curves_model.pth",
-        "data/model/buttons_model.pth",
-        "data/model/sleeves_model.pth",
-        "data/model/collars_model.pth"
-    ]
-    if not any(check_file_exists(model_path) for model_path in model_paths):
-        train_prop.main()  # Call the main function from 'train_prop.py'
-        print("5 - Train Prop Models")
-    find_prop.main()  # Call the main function from 'find_prop.py'
-    print("5 - Find Prop Models")
-
-
-# Step 6: Check Output Files - If specific output files don't exist, re-run previous steps as needed.
-def check_output_files():
-    output_files = [
-        "src/json/prop_output.json",
-        "src/json/global_output.json",
-    ]
-
-    if not check_file_exists(output_files[0]):
-        print("Warning: Missing global_output.json files")
-        train_and_find_global_model()
-
-    if not check_file_exists(output_files[1]):
-        print("Warning:Missing prop_output.json files")
-        train_and_find_prop_models()
-
-
-# Step 7: Run Compound by calling the main function from 'compound.py' if 'compound_output.json' doesn't exist.
+# Step 3b: Extract the ResNet-50 features of the training images once, before the models that train on them start
+# concurrently.
+def extract_train_features():
+    import src.model.feature_cache as feature_cache
+    feature_cache.main()  # Call the main function from 'feature_cache.py'
+    print("3b - Extract Training Features")
+
+
+# Step 4: Train the Global Model.
+def train_global_model(backbone="resnet50"):
+    import src.global_classifier.train_global as train_global
+    train_global.main(backbone=backbone)  # Call the main function from 'train_global.py'
+    print("4 - Train Global Model")
+
+
+# Step 5: Train the Prop Models.
+def train_prop_models(workers=None, backbones=None):
+    import src.props.train_prop as train_prop
+    train_prop.main(workers=workers, backbones=backbones)  # Call the main function from 'train_prop.py'
+    print("5 - Train Prop Models")
+
+
+# Step 5b: Train the Sub-Prop Models, which the pipeline does not train by default.
+def train_sub_prop_models(workers=None, backbones=None):
+    import src.sub_props.train_sub_prop as train_sub_prop
+    train_sub_prop.main(workers=workers, backbones=backbones)
+    print("5b - Train Sub-Prop Models")
+
+
+# Steps 4 and 5 at once: train every global, prop and sub-prop head on one shared backbone pass per batch.
+def train_multitask_models():
+    import src.training.train_multitask as train_multitask
+    train_multitask.main()  # Call the main function from 'train_multitask.py'
+    print("4/5 - Train All Models Jointly")
+
+
+# Step 6a: Export the optimized TorchScript backbones of the trained models, so the find stage only loads them.
+def export_optimized_models():
+    import src.inference.export_models as export_models
+    export_models.main()  # Call the main function from 'export_models.py'
+    print("6a - Export Optimized Models")
+
+
+# Step 6: Find the Global and Prop Models together, running the shared backbone once per test batch.
+def find_all_models(quantize=False, optimize=True, export_json=False):
+    import src.inference.find_all as find_all
+    # Call the main function from 'find_all.py'
+    find_all.main(export_json=export_json, quantize=quantize, optimize=optimize)
+    print("6 - Find All Models")
+
+
+# Step 7: Run Compound by calling the main function from 'compound.py'.
 def run_compound():
-    compound_file_path = "data/json/compound_output.json"
-    if not check_file_exists(compound_file_path):
-        compound_models.main()
-        print("8 - Run Compound")
+    import src.compound_models as compound_models
+    compound_models.main()
+    print("7 - Run Compound")
 
 
 # Step 8: Run Reasoning
-def run_reasoning():
-    output_file = "src/json/compound_output.json"
-    if not check_file_exists(output_file):
-        run_compound()
-    reasoning.main()
-    print("9 - Run Reasoning")
+def run_reasoning(method="compiled", cross_check=False, use_reasoner_service=False, explanation_format="text"):
+    import src.reasoning as reasoning
+    reasoning.main(method, cross_check, use_reasoner_service, explanation_format)
+    print("8 - Run Reasoning")
 
 
-# Main function
-def main():
-    create_ontology()
+# Step 8b: Write the explanations of the last reasoning run again, from the verdict cache
+def run_explanation(explanation_format="text"):
+    import src.reasoning as reasoning
+    reasoning.explain(explanation_format)
+    print("8b - Write Explanations")
+
+
+# Code shared by all the stages that load images or models
+MODEL_CODE = [path("src/model/model.py"), path("src/model/feature_cache.py"), path("src/model/checkpoint.py"),
+              path("src/dataset/dataset.py"), path("src/dataset/preprocess.py"), path("src/dataset/image_store.py")]
+
+# What export and find load, whichever stage or train command wrote them. A head-only checkpoint names its backbone
+# file by hash, so a new backbone also changes the checkpoint
+CHECKPOINT_FILES = [get_checkpoint_path(path("data/model"), task) for task in get_tasks()]
+
+# What compound reads: the label columns of the prediction store, or the JSON of the standalone find modules
+PREDICTION_FILES = [path("data/predictions/test/meta.json")] + \
+    [path(f"data/predictions/test/{name}.npy") for name in ["global"] + list(PROP_CLASSES)] + \
+    [path("data/json/global_output.json"), path("data/json/prop_output.json")]
+
+# Each stage reruns when its inputs, its code or a stage it depends on changed, or when an output is missing.
+# Global and prop training do not depend on each other and run concurrently, on the features extracted before.
+STAGES = [
+    {"name": "create_ontology", "run": create_ontology,
+     "code": [path("src/ontology/create_ontology.py")],
+     "outputs": [path("data/ontology/ontology.owl")]},
+    {"name": "relabel", "run": relabel_dataset,
+     "inputs": [path("data/csv/train.csv")],
+     "code": [path("src/dataset/relabel_dataset.py"), path("src/dataset/sub_property_relabel_dataset.py"),
+              path("src/dataset/image_store.py")],
+     "outputs": [path("data/csv/train.store/meta.json")]},
+    # No outputs, the cache file is named by the hash of the images and the backbone, and a training stage
+    # extracts the features itself if it is missing
+    {"name": "features", "run": extract_train_features, "deps": ["relabel"],
+     "inputs": [path("data/csv/train.csv")],
+     "code": MODEL_CODE},
+    {"name": "train_global", "run": train_global_model, "deps": ["relabel", "features"],
+     "inputs": [path("data/csv/train.csv")],
+     "code": [path("src/global_classifier/train_global.py")] + MODEL_CODE,
+     "outputs": [path("data/model/global_model.pth")]},
+    {"name": "train_prop", "run": train_prop_models, "deps": ["relabel", "features"],
+     "inputs": [path("data/csv/train.csv")],
+     "code": [path("src/props/train_prop.py"), path("src/dataset/relabel_dataset.py"),
+              path("src/training/scheduler.py"), path("src/tasks.py")] + MODEL_CODE,
+     "outputs": [path(f"data/model/{prop}_model.pth") for prop in PROP_CLASSES]},
+    # No outputs, the optimized backbones are named by their hash and find freezes a missing one itself
+    {"name": "export", "run": export_optimized_models, "deps": ["train_global", "train_prop"],
+     "inputs": CHECKPOINT_FILES,
+     "code": [path("src/inference/export_models.py"), path("src/model/optimize.py"),
+              path("src/inference/find_all.py"), path("src/tasks.py")] + MODEL_CODE},
+    {"name": "find", "run": find_all_models, "deps": ["export"],
+     "inputs": [path("data/csv/test.csv")] + CHECKPOINT_FILES,
+     "code": [path("src/inference/find_all.py"), path("src/inference/batching.py"),
+              path("src/prediction_store.py"), path("src/model/optimize.py"), path("src/tasks.py")] + MODEL_CODE,
+     "outputs": [path("data/predictions/test/meta.json")]},
+    {"name": "compound", "run": run_compound, "deps": ["find"],
+     "inputs": PREDICTION_FILES,
+     "code": [path("src/compound_models.py"), path("src/prediction_store.py")],
+     "outputs": [path("data/json/compound_output.json")]},
+    {"name": "reason", "run": run_reasoning, "deps": ["create_ontology", "compound"],
+     "inputs": [path("data/ontology/ontology.owl"), path("data/json/compound_output.json")],
+     "code": [path("src/reasoning.py"), path("src/explanation.py"), path("src/ontology/compile_ontology.py"),
+              path("src/ontology/verdict_cache.py"), path("src/ontology/reasoner_service.py")],
+     "outputs": [path("explanation.txt"), path("data/ontology/ontology_populated.owl")]},
+]
+
+
+# Replaces the global and prop training stages with a single multi-task stage that also trains the sub-props
+MULTITASK_STAGE = {
+    "name": "train_multitask", "run": train_multitask_models, "deps": ["relabel", "features"],
+    "inputs": [path("data/csv/train.csv")],
+    "code": [path("src/training/train_multitask.py"), path("src/dataset/relabel_dataset.py"),
+             path("src/dataset/sub_property_relabel_dataset.py"), path("src/tasks.py")] + MODEL_CODE,
+    "outputs": CHECKPOINT_FILES,
+}
+
+
+def get_stages(multitask=False):
+    if not multitask:
+        return STAGES
+
+    stages = []
+    for stage in STAGES:
+        if stage["name"] in ("train_global", "train_prop"):
+            continue
+        if stage["name"] == "export":
+            stage = dict(stage, deps=["train_multitask"])
+        stages.append(stage)
+    return stages + [MULTITASK_STAGE]
+
+
+def serve(host="127.0.0.1", port=8000, socket_path=None, max_batch_size=32, max_wait_ms=5.0, quantize=False):
+    import src.serving.server as server
+    server.main(host, port, socket_path, max_batch_size, max_wait_ms, quantize)
+
+
+# Every stage whose inputs, code or dependencies changed, skipping the up-to-date ones
+def run(force=(), multitask=False):
     check_training_testing_files()
-    train_and_find_global_model()
+    run_pipeline(get_stages(multitask), path("data/pipeline_state.json"), force=force)
+
+
+def parse_task_backbones(values, default="resnet50"):
+    """Backbone of every task of get_tasks(), default unless one of values, e.g. body_part/feet=native, sets it."""
+    tasks = get_tasks()
+    backbones = dict.fromkeys(tasks, default)
+    for value in values:
+        task, _, backbone = value.partition("=")
+        if task not in tasks:
+            raise ValueError(f"Unknown task {task}, expected one of {', '.join(tasks)}")
+        if backbone not in BACKBONES:
+            raise ValueError(f"Unknown backbone {backbone} for {task}, expected one of {', '.join(BACKBONES)}")
+        backbones[task] = backbone
+    return backbones
+
+
+def train(multitask=False, sub_props=False, backbones=None, workers=None):
+    # backbones maps every task to its backbone, as returned by parse_task_backbones
+    backbones = backbones or parse_task_backbones([])
     relabel_dataset()
-    train_and_find_prop_models()
-    check_output_files()
-    run_compound()
-    run_reasoning()
+    if multitask:
+        train_multitask_models()
+        return
+    train_global_model(backbones["global"])
+    train_prop_models(workers, {prop: backbones[prop] for prop in PROP_CLASSES})
+    if sub_props:
+        train_sub_prop_models(workers, {task: backbone for task, backbone in backbones.items() if "/" in task})
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Fashion-MNIST clothes classification and ontology reasoning.")
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="run the stages that are out of date (the default)")
+    run_parser.add_argument("--force", nargs="*", default=[], metavar="STAGE", help="stages to run regardless")
+    run_parser.add_argument("--multitask", action="store_true", help="train every head jointly")
+
+    commands.add_parser("ontology", help="create the ontology")
+
+    train_parser = commands.add_parser("train", help="train the models")
+    train_parser.add_argument("--multitask", action="store_true", help="train every head jointly")
+    train_parser.add_argument("--sub-props", action="store_true", help="also train the sub-property models")
+    train_parser.add_argument("--backbone", default="resnet50", choices=BACKBONES,
+                              help="backbone of every single-task model")
+    train_parser.add_argument("--task-backbone", action="append", default=[], metavar="TASK=BACKBONE",
+                              help="backbone of one task, e.g. edge_shape=native or body_part/feet=native")
+    train_parser.add_argument("--workers", type=int, default=None, help="concurrent training jobs")
+
+    infer_parser = commands.add_parser("infer", help="predict the test images with every trained model")
+    infer_parser.add_argument("--quantize", action="store_true", help="run the backbones in int8 on the CPU")
+    infer_parser.add_argument("--no-optimize", action="store_true", help="run the backbones in eager mode")
+    infer_parser.add_argument("--export-json", action="store_true", help="also write the per-model JSON files")
+
+    commands.add_parser("compound", help="combine the predictions into compound_output.json")
+
+    reason_parser = commands.add_parser("reason", help="check the predictions against the ontology")
+    reason_parser.add_argument("--method", default="compiled", choices=["compiled", "reasoner"])
+    reason_parser.add_argument("--cross-check", action="store_true", help="check the compiled verdicts with the "
+                                                                           "reasoner")
+    reason_parser.add_argument("--reasoner-service", action="store_true", help="keep one reasoner process warm")
+    reason_parser.add_argument("--format", default="text", choices=["text", "jsonl"], help="explanation format")
+
+    explain_parser = commands.add_parser("explain", help="write the explanations of the last reasoning again")
+    explain_parser.add_argument("--format", default="text", choices=["text", "jsonl"], help="explanation format")
+
+    serve_parser = commands.add_parser("serve", help="serve predictions over HTTP")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--socket", default=None, help="Unix socket path instead of host and port")
+    serve_parser.add_argument("--max-batch-size", type=int, default=32)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    serve_parser.add_argument("--quantize", action="store_true", help="run the backbones in int8 on the CPU")
+    return parser
+
+
+# Main function
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    if args.command in (None, "run"):
+        run(getattr(args, "force", ()), getattr(args, "multitask", False))
+    elif args.command == "ontology":
+        create_ontology()
+    elif args.command == "train":
+        if args.multitask and (args.backbone != "resnet50" or args.task_backbone):
+            parser.error("the multi-task model only has a ResNet-50 backbone")
+        try:
+            backbones = parse_task_backbones(args.task_backbone, args.backbone)
+        except ValueError as e:
+            parser.error(str(e))
+        train(args.multitask, args.sub_props, backbones, args.workers)
+    elif args.command == "infer":
+        find_all_models(args.quantize, not args.no_optimize, args.export_json)
+    elif args.command == "compound":
+        run_compound()
+    elif args.command == "reason":
+        run_reasoning(args.method, args.cross_check, args.reasoner_service, args.format)
+    elif args.command == "explain":
+        run_explanation(args.format)
+    elif args.command == "serve":
+        serve(args.host, args.port, args.socket, args.max_batch_size, args.max_wait_ms, args.quantize)
 
 
 if __name__ == "__main__":
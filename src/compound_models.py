@@ -1,6 +1,25 @@
 import json
 import os
 
+import numpy as np
+
+from src.prediction_store import get_store_mtime, is_newer_than_store, open_prediction_store, write_json_stream
+
+
+PROPS = ["body_part", "weather_type", "edge_shape"]
+
+# Category names indexed by predicted class, the last entry is used for codes outside of the table
+CLOTHES_NAMES = np.array(["TshirtTop", "Trouser", "Pullover", "Dress", "Coat", "Sandal", "Shirt", "Sneaker", "Bag",
+                          "AnkleBoot", "Unknown"])
+
+PROP_NAMES = {
+    "body_part": ("BodyPart", np.array(["WholeBody", "TopPart", "BottomPart", "Feet", "Hands", "Unknown"])),
+    "weather_type": ("WeatherType", np.array(["Cold", "Warm", "Any", "Unknown"])),
+    "edge_shape": ("EdgeShape", np.array(["StraightEdge", "CurveEdge", "Unknown"])),
+}
+
+CHUNK_SIZE = 65536
+
 
 def load_json(file_name):
     try:
@@ -10,64 +29,107 @@ def load_json(file_name):
         print(f"An error occurred while loading/reading the file: {e}")
 
 
+def load_prediction_store(store_dir):
+    """Read the prediction store of find_all as (image keys, global codes, {prop: codes}) memory-mapped columns."""
+    columns = open_prediction_store(store_dir, ["global"] + PROPS)
+    image_keys = np.arange(len(columns["global"]))
+    return image_keys, columns["global"], {prop: columns[prop] for prop in PROPS}
+
+
+def load_json_codes(file1_content, file2_content):
+    # Images without prop predictions get class 0, as in the original dict-based join
+    image_keys = list(file1_content)
+    global_codes = np.array([file1_content[key] for key in image_keys], dtype=np.int64)
+    prop_codes = {prop: np.array([file2_content.get(key, {}).get(prop, 0) for key in image_keys], dtype=np.int64)
+                  for prop in PROPS}
+    return image_keys, global_codes, prop_codes
+
+
+def get_name_index(codes, names):
+    # Index into names of every code, the index of "Unknown" for codes outside of the table
+    codes = np.asarray(codes, dtype=np.int64)
+    known = (codes >= 0) & (codes < len(names) - 1)
+    return np.where(known, codes, len(names) - 1)
+
+
+def decode(codes, names):
+    """Category name of every code, "Unknown" (the last name) for codes outside of the table."""
+    return names[get_name_index(codes, names)]
+
+
+def combine_chunk(image_keys, global_codes, prop_codes):
+    """Return the image names, the Clothes names and {category: names} of a chunk of predictions."""
+    image_names = [f"Image_{key}" for key in image_keys]
+    clothes = decode(global_codes, CLOTHES_NAMES)
+    properties = {category: decode(prop_codes[prop], names) for prop, (category, names) in PROP_NAMES.items()}
+    return image_names, clothes, properties
+
+
 def combine_json_files(file1_content, file2_content):
-    clothes_mapping = {
-        0: "TshirtTop",
-        1: "Trouser",
-        2: "Pullover",
-        3: "Dress",
-        4: "Coat",
-        5: "Sandal",
-        6: "Shirt",
-        7: "Sneaker",
-        8: "Bag",
-        9: "AnkleBoot"
-    }
-
-    body_part_mapping = {
-        0: "WholeBody",
-        1: "TopPart",
-        2: "BottomPart",
-        3: "Feet",
-        4: "Hands"
-    }
-
-    weather_type_mapping = {
-        0: "Cold",
-        1: "Warm",
-        2: "Any"
-    }
-
-    edge_shape_mapping = {
-        0: "StraightEdge",
-        1: "CurveEdge"
-    }
+    image_keys, global_codes, prop_codes = load_json_codes(file1_content, file2_content)
+    image_names, clothes, properties = combine_chunk(image_keys, global_codes, prop_codes)
 
     combined_json = {}
-
-    for key in file1_content:
-        image_number = f"Image_{key}"
+    for i, image_number in enumerate(image_names):
         combined_json[image_number] = {
-            "Clothes": clothes_mapping.get(file1_content[key], "Unknown"),
-            "Properties": {
-                "BodyPart": body_part_mapping.get(file2_content.get(key, {}).get("body_part", 0), "Unknown"),
-                "WeatherType": weather_type_mapping.get(file2_content.get(key, {}).get("weather_type", 0), "Unknown"),
-                "EdgeShape": edge_shape_mapping.get(file2_content.get(key, {}).get("edge_shape", 0), "Unknown")
-            }
+            "Clothes": str(clothes[i]),
+            "Properties": {category: str(names[i]) for category, names in properties.items()}
         }
     return combined_json
 
 
-def write_json_file(file_path, data):
+def format_entry_body(clothes, properties):
+    # Same text as json.dump(combined_json, indent=4) for the value of one image
+    lines = ['{', f'        "Clothes": {json.dumps(clothes)},', '        "Properties": {']
+    lines += [f'            "{category}": {json.dumps(name)}' + ("," if j < len(properties) - 1 else "")
+              for j, (category, name) in enumerate(properties.items())]
+    lines += ['        }', '    }']
+    return "\n".join(lines)
+
+
+def format_chunk(image_keys, global_codes, prop_codes):
+    """
+    Format the entries of a chunk. Every image is one of a few hundred (Clothes, properties) combinations, so
+    the combinations are numbered with integer arithmetic and each one is rendered only once.
+    """
+    tables = [("Clothes", CLOTHES_NAMES, global_codes)] + [(category, names, prop_codes[prop])
+                                                           for prop, (category, names) in PROP_NAMES.items()]
+    combination = np.zeros(len(global_codes), dtype=np.int64)
+    for _, names, codes in tables:
+        combination = combination * len(names) + get_name_index(codes, names)
+    unique_combinations, inverse = np.unique(combination, return_inverse=True)
+
+    bodies = []
+    for value in unique_combinations.tolist():
+        indices = []
+        for _, names, _ in reversed(tables):
+            value, index = divmod(value, len(names))
+            indices.append(index)
+        indices.reverse()
+        clothes = str(CLOTHES_NAMES[indices[0]])
+        properties = {category: str(names[index]) for (category, names, _), index in zip(tables[1:], indices[1:])}
+        bodies.append(format_entry_body(clothes, properties))
+
+    return [f'    {json.dumps(f"Image_{key}")}: {bodies[j]}' for key, j in zip(image_keys, inverse.ravel().tolist())]
+
+
+def write_compound_file(output_file_path, image_keys, global_codes, prop_codes, chunk_size=CHUNK_SIZE):
+    """Join and write the predictions chunk by chunk, so memory stays bounded by chunk_size images."""
+    def chunks():
+        for start in range(0, len(global_codes), chunk_size):
+            stop = start + chunk_size
+            chunk_codes = {prop: codes[start:stop] for prop, codes in prop_codes.items()}
+            yield format_chunk(image_keys[start:stop], global_codes[start:stop], chunk_codes)
+
     try:
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
+        write_json_stream(output_file_path, chunks())
     except IOError as e:
         print(f"An error occurred while writing to the file: {e}")
 
 
-def main():
+def main(chunk_size=CHUNK_SIZE):
     current_dir = os.path.dirname(os.path.abspath(__file__))
+    store_dir = os.path.join(current_dir, '../data/predictions/test')
     current_dir = os.path.join(current_dir, '../data/json')
 
     # Paths to the input JSON files and the output file
@@ -75,15 +137,22 @@ def main():
     file2_path = os.path.join(current_dir, 'prop_output.json')
     output_file_path = os.path.join(current_dir, 'compound_output.json')
 
-    # Loading the input files
-    file1_content = load_json(file1_path)
-    file2_content = load_json(file2_path)
-
-    # Combining the contents
-    combined_content = combine_json_files(file1_content, file2_content)
-
-    # Writing the combined content to a new file
-    write_json_file(output_file_path, combined_content)
+    # Loading the predictions as integer codes, from the store written by find_all unless the standalone find
+    # modules wrote JSON files since
+    use_store = get_store_mtime(store_dir) is not None
+    if use_store and any(is_newer_than_store(file_path, store_dir) for file_path in (file1_path, file2_path)):
+        if os.path.exists(file1_path) and os.path.exists(file2_path):
+            use_store = False
+        else:
+            print("Newer JSON predictions found for only some of the heads, reading the prediction store")
+
+    if use_store:
+        image_keys, global_codes, prop_codes = load_prediction_store(store_dir)
+    else:
+        image_keys, global_codes, prop_codes = load_json_codes(load_json(file1_path), load_json(file2_path))
+
+    # Combining the predictions and writing them to a new file
+    write_compound_file(output_file_path, image_keys, global_codes, prop_codes, chunk_size)
 
     print(f"Combined JSON file has been saved to: {output_file_path}")
 
@@ -1,6 +1,19 @@
 import os
 import json
 
+import numpy as np
+
+from src.prediction_store import open_prediction_scores, open_prediction_store, write_json_stream
+
+
+PROPERTIES = {
+    "body_part": ["whole_body", "top_part", "bottom_part", "feet", "hands"],
+    "weather_type": ["cold", "warm", "any"],
+    "edge_shape": ["straight_edge", "curve_edge"]
+}
+
+CHUNK_SIZE = 65536
+
 
 def load_json(file_name):
     """Safely load JSON data from a file."""
@@ -12,53 +25,166 @@ def load_json(file_name):
         return None
 
 
-def write_json_file(file_path, data):
-    """Safely write data to a JSON file."""
+def get_family_slices(properties):
+    """Columns of every property in the (N, n_sub_properties) score matrix, e.g. {"body_part": slice(0, 5)}."""
+    slices, start = {}, 0
+    for prop, sub_props in properties.items():
+        slices[prop] = slice(start, start + len(sub_props))
+        start += len(sub_props)
+    return slices
+
+
+def load_json_scores(base_dir, properties):
+    """
+    Read the {prop}/{sub_prop}.json files as image keys and one score column per sub-property, in the column
+    order of the score matrix. Images are keyed in the order they first appear; a missing file or image scores 0.
+    """
+    data = {}
+    image_keys = {}
+    for property_name, sub_properties in properties.items():
+        for sub_property in sub_properties:
+            content = load_json(os.path.join(base_dir, property_name, f"{sub_property}.json"))
+            data[(property_name, sub_property)] = content or {}
+            image_keys.update(dict.fromkeys(content or {}))
+
+    image_keys = list(image_keys)
+    columns = [np.array([float(data[(property_name, sub_property)].get(key) or 0) for key in image_keys],
+                        dtype=np.float32)
+               for property_name, sub_properties in properties.items() for sub_property in sub_properties]
+    return image_keys, columns
+
+
+def load_store_scores(store_dir, properties):
+    """
+    Same as load_json_scores, from the prediction store written by find_all, plus the stored labels of every
+    sub-property. The labels decide which sub-properties are positive, so the thresholds applied by redecode are
+    kept; the scores only pick the most confident one among several positives.
+    """
+    names = [f"{prop}/{sub_prop}" for prop, sub_props in properties.items() for sub_prop in sub_props]
+    labels = open_prediction_store(store_dir, names)
+
     try:
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-    except IOError as e:
-        print(f"An error occurred while writing to the file: {e}")
+        scores = open_prediction_scores(store_dir, names)
+    except KeyError:
+        print("No stored scores, decoding the binary predictions")
+        scores = labels
 
+    # The memory-mapped columns are only read chunk by chunk when decoding
+    return np.arange(len(labels[names[0]])), [scores[name] for name in names], [labels[name] for name in names]
 
-def combine_json_files(base_dir, properties):
-    """Combine JSON files for each sub-property into a single structure."""
-    combined_data = {}
 
-    for property_name, sub_properties in properties.items():
-        for sub_index, sub_property in enumerate(sub_properties):
-            file_path = os.path.join(base_dir, property_name, f"{sub_property}.json")
-            data = load_json(file_path)
+def build_score_matrix(columns, start=0, stop=None):
+    # (N, n_sub_properties) scores of the images in [start, stop)
+    return np.stack([np.asarray(column[start:stop], dtype=np.float32) for column in columns], axis=1)
+
 
-            if data is not None:
-                for img_id, presence in data.items():
-                    if img_id not in combined_data:
-                        combined_data[img_id] = {prop: None for prop in properties.keys()}
+def decode_families(scores, slices, threshold=0.5, labels=None):
+    """
+    Decode every property from its slice of the score matrix. An image gets the sub-property with the highest
+    score among the positive ones, the first one on ties, and -1 when none is positive. The positives are the
+    non-zero entries of the labels matrix when given, the scores above threshold otherwise. Returns
+    ({prop: codes}, {prop: multi_hit}, {prop: no_hit}), the flags marking images with several or no positives.
+    """
+    positive = labels != 0 if labels is not None else scores > threshold
 
-                    if presence == 1:
-                        combined_data[img_id][property_name] = sub_index
+    codes, multi_hit, no_hit = {}, {}, {}
+    for prop, columns in slices.items():
+        family_scores = scores[:, columns]
+        family_positive = positive[:, columns]
+        hits = family_positive.sum(axis=1)
+        best = np.argmax(np.where(family_positive, family_scores, -np.inf), axis=1)
 
+        codes[prop] = np.where(hits > 0, best, -1)
+        multi_hit[prop] = hits > 1
+        no_hit[prop] = hits == 0
+    return codes, multi_hit, no_hit
+
+
+def format_value(codes, multi_hit, no_hit, row):
+    props = list(codes)
+    values = {prop: int(codes[prop][row]) if codes[prop][row] >= 0 else None for prop in props}
+    values["multi_hit"] = [prop for prop in props if multi_hit[prop][row]]
+    values["no_hit"] = [prop for prop in props if no_hit[prop][row]]
+    return values
+
+
+def combine_json_files(base_dir, properties, threshold=0.5):
+    """Combine JSON files for each sub-property into a single structure."""
+    image_keys, columns = load_json_scores(base_dir, properties)
+    codes, multi_hit, no_hit = decode_families(build_score_matrix(columns), get_family_slices(properties),
+                                               threshold)
+
+    combined_data = {}
+    for i, img_id in enumerate(image_keys):
+        combined_data[img_id] = format_value(codes, multi_hit, no_hit, i)
     return combined_data
 
 
-def main():
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    base_dir = os.path.join(current_dir, '../data/json')
+def format_chunk(image_keys, codes, multi_hit, no_hit):
+    """
+    Format the entries of a chunk as json.dump(..., indent=4) would, rendering each distinct combination of
+    decoded values and flags only once.
+    """
+    combination = np.zeros(len(image_keys), dtype=np.int64)
+    for prop in codes:
+        # -1 (no hit) becomes 0 and the sub-property indices 1 and up, times two for the multi-hit flag
+        combination = combination * (2 * codes[prop].max(initial=0) + 4) + 2 * (codes[prop] + 1) + multi_hit[prop]
+    _, first, inverse = np.unique(combination, return_index=True, return_inverse=True)
+
+    bodies = []
+    for row in first.tolist():
+        body = json.dumps(format_value(codes, multi_hit, no_hit, row), indent=4)
+        bodies.append(body.replace("\n", "\n    "))
+
+    return [f'    {json.dumps(str(key))}: {bodies[j]}' for key, j in zip(image_keys, inverse.ravel().tolist())]
+
+
+def write_combined_file(output_file_path, image_keys, columns, properties, threshold=0.5, chunk_size=CHUNK_SIZE,
+                        label_columns=None):
+    """
+    Decode and write the sub-property predictions chunk by chunk, so memory stays bounded by chunk_size.
+    With label_columns, the stored labels decide the positives instead of threshold.
+    """
+    slices = get_family_slices(properties)
+    counts = {"multi_hit": 0, "no_hit": 0}
+
+    def chunks():
+        for start in range(0, len(image_keys), chunk_size):
+            stop = start + chunk_size
+            labels = None if label_columns is None else build_score_matrix(label_columns, start, stop)
+            codes, multi_hit, no_hit = decode_families(build_score_matrix(columns, start, stop), slices, threshold,
+                                                       labels)
+            counts["multi_hit"] += int(sum(flags.sum() for flags in multi_hit.values()))
+            counts["no_hit"] += int(sum(flags.sum() for flags in no_hit.values()))
+            yield format_chunk(image_keys[start:stop], codes, multi_hit, no_hit)
 
-    properties = {
-        "body_part": ["whole_body", "top_part", "bottom_part", "feet", "hands"],
-        "weather_type": ["cold", "warm", "any"],
-        "edge_shape": ["straight_edge", "curve_edge"]
-    }
+    try:
+        write_json_stream(output_file_path, chunks())
+    except IOError as e:
+        print(f"An error occurred while writing to the file: {e}")
+    print(f"{counts['multi_hit']} properties with several positive sub-properties, {counts['no_hit']} with none")
 
-    # Combine JSON files according to specified properties
-    combined_data = combine_json_files(base_dir, properties)
+
+def main(threshold=0.5, chunk_size=CHUNK_SIZE):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    base_dir = os.path.join(current_dir, '../data/json')
+    store_dir = os.path.join(current_dir, '../data/predictions/test')
+
+    # Read the sub-property predictions, from the store written by find_all when it has them
+    image_keys, columns, label_columns = None, None, None
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        try:
+            image_keys, columns, label_columns = load_store_scores(store_dir, PROPERTIES)
+        except KeyError as e:
+            print(f"Using the JSON files instead of the prediction store: {e}")
+    if columns is None:
+        image_keys, columns = load_json_scores(base_dir, PROPERTIES)
 
     # Define the path for the output combined JSON file
     output_file_path = os.path.join(base_dir, 'combined_sub_models_output.json')
 
-    # Write the combined data to a JSON file
-    write_json_file(output_file_path, combined_data)
+    # Combine the sub-properties and write the combined data to a JSON file
+    write_combined_file(output_file_path, image_keys, columns, PROPERTIES, threshold, chunk_size, label_columns)
 
     print(f"Combined JSON data saved to {output_file_path}")
 
@@ -1,7 +1,12 @@
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 import pandas as pd
 from PIL import Image
 
+from src.dataset.image_store import open_image_store
+from src.dataset.relabel_dataset import build_label_lookup
+
 
 class CustomDataset(Dataset):
     def __init__(self, csv_file, transform=None):
@@ -41,3 +46,81 @@ class CustomTestDataset(Dataset):
             image = self.transform(image)
 
         return image
+
+
+class ImageStoreDataset(Dataset):
+    def __init__(self, store_dir, transform=None):
+        self.store_dir = store_dir
+        self.transform = transform
+
+        images, _ = open_image_store(store_dir)
+        self.length = len(images)
+
+        # Opened lazily in each process, so DataLoader workers share the page cache instead of a pickled copy
+        self.images = None
+        self.labels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['labels'] = None
+        return state
+
+    def open(self):
+        if self.images is None:
+            self.images, self.labels = open_image_store(self.store_dir)
+
+    def __len__(self):
+        return self.length
+
+    def load_image(self, idx):
+        self.open()
+        # The memory-mapped uint8 image is read directly, without going through an int64 DataFrame row
+        image = self.images[idx]
+
+        # Without a transform the raw (28, 28) image is returned, to be preprocessed per batch by collate_images
+        if self.transform:
+            image = self.transform(Image.fromarray(image).convert('RGB'))
+
+        return image
+
+    def __getitem__(self, idx):
+        image = self.load_image(idx)
+        return image, self.labels[idx]
+
+
+class ImageStoreTestDataset(ImageStoreDataset):
+    def __getitem__(self, idx):
+        return self.load_image(idx)
+
+
+class FeatureDataset(Dataset):
+    def __init__(self, features, labels=None):
+        # features is usually a read-only memory-mapped array from the feature cache
+        self.features = features
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, idx):
+        features = torch.from_numpy(np.array(self.features[idx], dtype=np.float32))
+
+        if self.labels is None:
+            return features
+
+        return features, self.labels[idx]
+
+
+class LabelViewDataset(Dataset):
+    def __init__(self, dataset, mappings):
+        # Relabels a labeled dataset on the fly, so every target shares the same images instead of a CSV copy
+        self.dataset = dataset
+        self.lookup = build_label_lookup(mappings)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        return image, self.lookup[label]
@@ -0,0 +1,109 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+IMAGE_SHAPE = (28, 28)
+
+
+def get_store_dir(csv_file):
+    # data/csv/train.csv -> data/csv/train.store
+    return os.path.splitext(csv_file)[0] + ".store"
+
+
+def get_source_info(csv_file):
+    stat = os.stat(csv_file)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def is_store_current(csv_file, store_dir):
+    meta_path = os.path.join(store_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+
+    with open(meta_path, 'r') as file:
+        meta = json.load(file)
+    source_info = get_source_info(csv_file)
+    return all(meta.get(key) == value for key, value in source_info.items())
+
+
+def count_rows(csv_file):
+    with open(csv_file, 'rb') as file:
+        return sum(1 for _ in file) - 1  # Minus the header
+
+
+def convert_csv_to_store(csv_file, store_dir, chunk_size=10000):
+    """
+    Convert a Fashion-MNIST CSV into images.npy, a uint8 (N, 28, 28) array, and labels.npy when the CSV has
+    a 'label' column. The CSV is read in chunks so the int64 DataFrame is never held in memory at once.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    meta_path = os.path.join(store_dir, "meta.json")
+    if os.path.exists(meta_path):
+        # The store is only valid once meta.json is written again at the end
+        os.remove(meta_path)
+
+    n_images = count_rows(csv_file)
+    images_path = os.path.join(store_dir, "images.npy")
+    labels_path = os.path.join(store_dir, "labels.npy")
+    images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=(n_images, *IMAGE_SHAPE))
+    labels = None
+
+    start = 0
+    for chunk in pd.read_csv(csv_file, chunksize=chunk_size):
+        if 'label' in chunk.columns:
+            if labels is None:
+                labels = np.empty(n_images, dtype=np.int64)
+            labels[start:start + len(chunk)] = chunk['label'].values
+            chunk = chunk.drop(columns=['label'])
+
+        images[start:start + len(chunk)] = chunk.to_numpy(dtype=np.uint8).reshape(-1, *IMAGE_SHAPE)
+        start += len(chunk)
+
+    images.flush()
+    del images
+
+    if labels is not None:
+        np.save(labels_path, labels)
+    elif os.path.exists(labels_path):
+        os.remove(labels_path)
+
+    meta = {"source": os.path.basename(csv_file), "n_images": n_images, "has_labels": labels is not None}
+    meta.update(get_source_info(csv_file))
+    with open(meta_path, 'w') as file:
+        json.dump(meta, file, indent=4)
+
+    print(f"Image store for {csv_file} saved to {store_dir}")
+
+
+def ensure_image_store(csv_file):
+    """Return the store directory of csv_file, converting the CSV first if the store is missing or outdated."""
+    store_dir = get_store_dir(csv_file)
+    if not is_store_current(csv_file, store_dir):
+        convert_csv_to_store(csv_file, store_dir)
+    return store_dir
+
+
+def open_image_store(store_dir):
+    """Memory-map the images of a store, returning (images, labels) where labels is None for unlabeled data."""
+    images = np.load(os.path.join(store_dir, "images.npy"), mmap_mode='r')
+    labels_path = os.path.join(store_dir, "labels.npy")
+    labels = np.load(labels_path, mmap_mode='r') if os.path.exists(labels_path) else None
+    return images, labels
+
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+
+    for csv_name in ["train.csv", "test.csv"]:
+        csv_file = os.path.join(current_dir, '../../data/csv', csv_name)
+        if os.path.exists(csv_file):
+            ensure_image_store(csv_file)
+        else:
+            print(f"File not found: {csv_file}")
+
+
+if __name__ == '__main__':
+    main()
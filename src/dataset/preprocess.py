@@ -0,0 +1,42 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+IMAGE_SIZE = (224, 224)
+NATIVE_IMAGE_SIZE = (28, 28)
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def preprocess_batch(images, image_size=IMAGE_SIZE):
+    """
+    Turn a uint8 (B, 28, 28) tensor into the normalized (B, 3, 224, 224) float input of the ResNet-50 models.
+    Same steps as Image.convert('RGB'), Resize((224, 224)), ToTensor() and Normalize() on every image,
+    done as a few tensor operations on the whole batch (on whichever device the images are on).
+    With image_size=NATIVE_IMAGE_SIZE the images keep their resolution, for the NativeCNN models.
+    """
+    x = images.to(torch.float32).div_(255).unsqueeze(1)
+    if tuple(x.shape[-2:]) != tuple(image_size):
+        x = F.interpolate(x, size=image_size, mode='bilinear', align_corners=False)
+
+    mean = torch.tensor(MEAN, dtype=x.dtype, device=x.device).view(1, 3, 1, 1)
+    std = torch.tensor(STD, dtype=x.dtype, device=x.device).view(1, 3, 1, 1)
+
+    # Broadcasting the single grey channel against the 3 channel statistics expands it to RGB
+    return (x - mean) / std
+
+
+def stack_images(images):
+    return torch.from_numpy(np.stack(images))
+
+
+def collate_images(batch, image_size=IMAGE_SIZE):
+    """
+    DataLoader collate_fn for datasets returning raw uint8 images, or (image, label) pairs, without a transform.
+    Use functools.partial to set image_size.
+    """
+    if isinstance(batch[0], tuple):
+        images, labels = zip(*batch)
+        return preprocess_batch(stack_images(images), image_size), torch.as_tensor(np.array(labels))
+    return preprocess_batch(stack_images(batch), image_size)
@@ -1,7 +1,59 @@
 import os
 
+import numpy as np
 import pandas as pd
 
+from src.dataset.image_store import ensure_image_store
+
+
+PROP_MAPPINGS = {
+    "body_part": {0: 1,
+                  1: 2,
+                  2: 1,
+                  3: 0,
+                  4: 3,
+                  5: 1,
+                  6: 1,
+                  7: 3,
+                  8: 4,
+                  9: 3},
+    "weather_type": {0: 1,
+                     1: 2,
+                     2: 0,
+                     3: 2,
+                     4: 1,
+                     5: 0,
+                     6: 2,
+                     7: 2,
+                     8: 2,
+                     9: 0},
+    "edge_shape": {0: 1,
+                   1: 0,
+                   2: 1,
+                   3: 0,
+                   4: 1,
+                   5: 1,
+                   6: 1,
+                   7: 1,
+                   8: 0,
+                   9: 0},
+}
+
+
+def build_label_lookup(mappings):
+    # Array form of a {label: new_label} mapping, so relabeling is a single indexing operation
+    if sorted(mappings) != list(range(len(mappings))):
+        raise ValueError(f"Mappings must cover the labels 0 to {len(mappings) - 1}")
+
+    lookup = np.empty(len(mappings), dtype=np.int64)
+    for label, new_label in mappings.items():
+        lookup[label] = new_label
+    return lookup
+
+
+def relabel(labels, mappings):
+    return build_label_lookup(mappings)[labels]
+
 
 def modify_labels(file_path, modified_file_path, mappings):
     try:
@@ -18,49 +70,22 @@ def modify_labels(file_path, modified_file_path, mappings):
         print(f"An error occurred: {e}")
 
 
-def main():
+def main(export_csv=False):
     current_dir = os.path.dirname(os.path.abspath(__file__))
 
     file_path = os.path.join(current_dir,'../../data/csv/train.csv')
 
-    bodypart_file_path = os.path.join(current_dir,'../../data/csv/props/body_part.csv')
-    bodypart_mappings = {0: 1,
-                         1: 2,
-                         2: 1,
-                         3: 0,
-                         4: 3,
-                         5: 1,
-                         6: 1,
-                         7: 3,
-                         8: 4,
-                         9: 3}
-    modify_labels(file_path, bodypart_file_path, bodypart_mappings)
-
-    weathertype_file_path = os.path.join(current_dir,'../../data/csv/props/weather_type.csv')
-    weathertype_mappings = {0: 1,
-                            1: 2,
-                            2: 0,
-                            3: 2,
-                            4: 1,
-                            5: 0,
-                            6: 2,
-                            7: 2,
-                            8: 2,
-                            9: 0}
-    modify_labels(file_path, weathertype_file_path, weathertype_mappings)
-
-    edgeshape_file_path = os.path.join(current_dir,'../../data/csv/props/edge_shape.csv')
-    edgeshape_mappings = {0: 1,
-                          1: 0,
-                          2: 1,
-                          3: 0,
-                          4: 1,
-                          5: 1,
-                          6: 1,
-                          7: 1,
-                          8: 0,
-                          9: 0}
-    modify_labels(file_path, edgeshape_file_path, edgeshape_mappings)
+    if export_csv:
+        # Relabeled full copies of train.csv, only needed by external tools
+        for prop, mappings in PROP_MAPPINGS.items():
+            modify_labels(file_path, os.path.join(current_dir, f'../../data/csv/props/{prop}.csv'), mappings)
+        return
+
+    # Training reads train.csv through LabelViewDataset, which relabels on the fly, so only the shared
+    # image store has to exist and the mappings have to be valid.
+    ensure_image_store(file_path)
+    for mappings in PROP_MAPPINGS.values():
+        build_label_lookup(mappings)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+import json
+
+
+EXPLAINED_PROPERTIES = {
+    'BodyPart': ['WholeBody', 'TopPart', 'BottomPart', 'Feet', 'Hands'],
+    'WeatherType': ['Cold', 'Warm', 'Any'],
+    'EdgeShape': ['StraightEdge', 'CurveEdge'],
+}
+
+
+def build_individual_index(onto):
+    """Map the name of every individual of the ontology to the individual, replacing one IRI search per image."""
+    return {individual.name: individual for individual in onto.individuals()}
+
+
+def property_tokens(value):
+    """Property names of one category, a single name, a comma or space separated string, or a list of names."""
+    if isinstance(value, str):
+        return set(value.replace(",", " ").split())
+    return set(value)
+
+
+def get_summary(total_items, inconsistent_count):
+    consistent_count = total_items - inconsistent_count
+    return {
+        "total": total_items,
+        "inconsistent": inconsistent_count,
+        "consistent": consistent_count,
+        "inconsistent_percentage": (inconsistent_count / total_items) * 100 if total_items else 0.0,
+        "consistent_percentage": (consistent_count / total_items) * 100 if total_items else 0.0,
+    }
+
+
+def explanation_records(index, json_data, inconsistent_individuals):
+    """
+    Yield one record per image of json_data: whether its individual is in the ontology, its class, whether it is
+    consistent and, for every explained property value, whether the image has it.
+    """
+    inconsistent = set(inconsistent_individuals)
+
+    for image_id, properties in json_data.items():
+        individual = index.get(image_id)
+        if individual is None:
+            yield {"image_id": image_id, "found": False}
+            continue
+
+        # Whole names are compared, so a name that is a substring of another one does not count as present
+        properties_present = {category: property_tokens(value)
+                              for category, value in properties.get("Properties", {}).items()}
+        yield {
+            "image_id": image_id,
+            "found": True,
+            "class": individual.is_a[0].name,
+            "consistent": image_id not in inconsistent,
+            "properties": {category: {prop: prop in properties_present.get(category, ()) for prop in prop_list}
+                           for category, prop_list in EXPLAINED_PROPERTIES.items()},
+        }
+
+
+def format_summary(summary):
+    return (f"Summary:\nTotal Items: {summary['total']}\n"
+            f"Inconsistent Items: {summary['inconsistent']} ({summary['inconsistent_percentage']:.2f}%)\n"
+            f"Consistent Items: {summary['consistent']} ({summary['consistent_percentage']:.2f}%)\n\n")
+
+
+def format_record(record):
+    image_id = record["image_id"]
+    if not record["found"]:
+        return f"{image_id} could not be found in the ontology. It may have been removed due to inconsistency."
+
+    explanation = f"{image_id} is a {record['class']}"
+    if record["consistent"]:
+        explanation += " and is consistent in the ontology"
+    else:
+        explanation += " and is NOT consistent, hence removed from the ontology."
+
+    prop_explanations = []
+    for category, values in record["properties"].items():
+        for prop, present in values.items():
+            if present:
+                prop_explanations.append(f"it has {prop} in {category}")
+            else:
+                prop_explanations.append(f"does not have {prop} in {category}")
+
+    return explanation + ". It " + ", ".join(prop_explanations) + "."
+
+
+def write_explanations(records, summary, explanation_file, output_format="text"):
+    """
+    Write the records as they are produced. "text" is the explanation.txt prose, "jsonl" is one JSON object per
+    line, the summary first.
+    """
+    with open(explanation_file, 'w') as file:
+        if output_format == "jsonl":
+            file.write(json.dumps({"summary": summary}) + "\n")
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+            return
+
+        first_entry = True  # No newline at the start or at the end of the file
+        for record in records:
+            if first_entry:
+                file.write(format_summary(summary))
+                file.write(format_record(record))
+                first_entry = False
+            else:
+                file.write("\n" + format_record(record))
@@ -1,54 +1,62 @@
 import os
+import time
+from functools import partial
 
 import torch
 from torch.utils.data import DataLoader
-import torchvision.transforms as transforms
-from src.dataset.dataset import CustomTestDataset
-from src.model.model import CustomMultiClassResNet
+from src.dataset.dataset import ImageStoreTestDataset
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import IMAGE_SIZE, collate_images
+from src.model.checkpoint import load_checkpoint
+from src.inference.scores import get_scores_path, output_scores, save_scores
+from src.inference.batching import autotune_batch_size, report_throughput
+from src.model.feature_cache import load_test_feature_data
 from src.dataset.test_remove_labels import check_and_remove_label_column
 import json
 
 
 def load_trained_model(model_path, n_classes):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = CustomMultiClassResNet(n_classes).to(device)
-    model.load_state_dict(torch.load(model_path, map_location=device))
-    model.eval()
-    return model
+    return load_checkpoint(model_path, n_classes, device=device)
 
 
-def load_data(csv_file):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-
-    dataset = CustomTestDataset(csv_file=csv_file, transform=transform)
-    data_loader = DataLoader(dataset, batch_size=1, shuffle=False)
+def load_data(csv_file, batch_size=64, forward=None, image_size=IMAGE_SIZE):
+    dataset = ImageStoreTestDataset(ensure_image_store(csv_file))
+    collate_fn = partial(collate_images, image_size=image_size)
+    if batch_size == "auto":
+        batch_size = autotune_batch_size(forward, dataset, collate_fn=collate_fn)
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
     return data_loader
 
 
 def generate_predictions(model, data_loader, output_file):
     predictions = {}
+    scores = []
     device = next(model.parameters()).device
 
-    with torch.no_grad():
-        for i, inputs in enumerate(data_loader):
+    image_count = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for inputs in data_loader:
             inputs = inputs.to(device)
             outputs = model(inputs)
 
-            # Get the index of the max logit
+            # Get the index of the max logit, and keep the class probabilities to decode them again later
             _, predicted = torch.max(outputs, 1)
-            predictions[i] = predicted.item()
+            scores.append(output_scores(outputs, model.use_sigmoid))
+            for prediction in predicted.tolist():
+                predictions[image_count] = prediction
+                image_count += 1
+    report_throughput("Global model", image_count, time.perf_counter() - start)
 
     with open(output_file, 'w') as f:
         json.dump(predictions, f, indent=4)
 
     print(f"Predictions saved to {output_file}")
+    save_scores(get_scores_path(output_file), scores)
 
 
-def main():
+def main(use_feature_cache=True, batch_size="auto"):
     n_classes = 10
 
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -61,7 +69,14 @@ def main():
     output_file = os.path.join(current_dir, '../../data/json/global_output.json')
 
     model = load_trained_model(model_path, n_classes)
-    test_loader = load_data(test_csv_file)
+    # Only a frozen backbone has cached features, the native models run on the images
+    if use_feature_cache and model.frozen_backbone:
+        test_loader = load_test_feature_data(test_csv_file, model)
+        model.from_features = True
+    else:
+        device = next(model.parameters()).device
+        test_loader = load_data(test_csv_file, batch_size, forward=lambda inputs: model(inputs.to(device)),
+                                image_size=model.image_size)
 
     generate_predictions(model, test_loader, output_file)
 
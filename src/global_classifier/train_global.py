@@ -1,28 +1,27 @@
 import os
+from functools import partial
 
 import torch
 import torch.optim as optim
-from torchvision import transforms
 from torch.utils.data import DataLoader, random_split
-from src.model.model import CustomMultiClassResNet
-from src.dataset.dataset import CustomDataset
+from src.model.model import create_model
+from src.model.checkpoint import save_checkpoint
+from src.model.feature_cache import load_feature_data
+from src.dataset.dataset import ImageStoreDataset
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import IMAGE_SIZE, collate_images
 
 
-def load_data(csv_file, validation_split=0.1):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-
-    dataset = CustomDataset(csv_file=csv_file, transform=transform)
+def load_data(csv_file, validation_split=0.1, image_size=IMAGE_SIZE):
+    dataset = ImageStoreDataset(ensure_image_store(csv_file))
     dataset_size = len(dataset)
     val_size = int(dataset_size * validation_split)
     train_size = dataset_size - val_size
     train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
 
-    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False)
+    collate_fn = partial(collate_images, image_size=image_size)
+    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, collate_fn=collate_fn)
+    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False, collate_fn=collate_fn)
     return train_loader, val_loader
 
 
@@ -72,15 +71,17 @@ def train(model, train_loader, val_loader, optimizer, epochs, model_save_path, p
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             early_stopping_counter = 0
-            torch.save(model.state_dict(), model_save_path)
+            save_checkpoint(model, model_save_path)
         else:
             early_stopping_counter += 1
             if early_stopping_counter >= patience:
                 print(f"Early stopping triggered after {patience} epochs with no improvement")
                 break
 
+    return best_val_loss
+
 
-def main():
+def main(use_feature_cache=True, backbone="resnet50"):
     # Parameters
     n_classes = 10
     epochs = 50
@@ -91,12 +92,18 @@ def main():
     csv_file = os.path.join(current_dir, '../../data/csv/train.csv')
     model_save_path = os.path.join(current_dir, '../../data/model/global_model.pth')
 
-    # Load data
-    train_loader, val_loader = load_data(csv_file)
-
-    # Model, Optimizer
+    # Model
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = CustomMultiClassResNet(n_classes).to(device)
+    model = create_model(n_classes, backbone=backbone).to(device)
+
+    # Load data, as cached backbone features when possible since the backbone is frozen
+    if use_feature_cache and model.frozen_backbone:
+        train_loader, val_loader = load_feature_data(csv_file, model)
+        model.from_features = True
+    else:
+        train_loader, val_loader = load_data(csv_file, image_size=model.image_size)
+
+    # Optimizer
     optimizer = optim.Adadelta(model.parameters())
 
     # Train with Early Stopping
@@ -0,0 +1,46 @@
+import time
+
+import torch
+from torch.utils.data import default_collate
+
+
+BATCH_SIZE_CANDIDATES = [1, 4, 16, 32, 64, 128]
+
+
+def autotune_batch_size(forward, dataset, collate_fn=default_collate, candidates=BATCH_SIZE_CANDIDATES,
+                        repeats=2):
+    """
+    Time forward on batches built from the first sample of dataset and return the candidate batch size
+    with the highest images/sec. The search stops as soon as a larger batch is clearly slower.
+    """
+    sample = dataset[0]
+    best_batch_size, best_rate = candidates[0], 0.0
+
+    with torch.inference_mode():
+        for batch_size in candidates:
+            inputs = collate_fn([sample] * batch_size)
+            try:
+                forward(inputs)  # Warm-up
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    forward(inputs)
+                elapsed = time.perf_counter() - start
+            except RuntimeError as e:
+                # Usually out of memory, larger batches will not work either
+                print(f"Batch size {batch_size} failed: {e}")
+                break
+
+            rate = batch_size * repeats / elapsed
+            print(f"Batch size {batch_size}: {rate:.1f} images/sec")
+            if rate > best_rate:
+                best_batch_size, best_rate = batch_size, rate
+            elif rate < 0.9 * best_rate:
+                break
+
+    print(f"Using batch size {best_batch_size}")
+    return best_batch_size
+
+
+def report_throughput(name, n_images, elapsed):
+    rate = n_images / elapsed if elapsed > 0 else float('inf')
+    print(f"{name}: {n_images} images in {elapsed:.1f}s ({rate:.1f} images/sec)")
@@ -0,0 +1,55 @@
+import os
+import time
+
+import torch
+
+from src.dataset.preprocess import preprocess_batch
+from src.inference.find_all import group_by_backbone, load_models
+from src.model.optimize import get_optimized_path, load_optimized_backbone
+
+
+def time_backbone(backbone, inputs, repeats=3):
+    with torch.inference_mode():
+        backbone(inputs)  # Warm-up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            features = backbone(inputs)
+    return features, (time.perf_counter() - start) / repeats
+
+
+def main(batch_size=64):
+    """
+    Export the optimized backbone of every backbone group of the trained models ahead of the find stage and check
+    it against the eager backbone. find_all and ClothesPipeline find the files by backbone hash, device and PyTorch
+    version, and freeze any that is missing themselves.
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    model_dir = os.path.join(current_dir, '../../data/model')
+
+    models = load_models(model_dir)
+    if not models:
+        print(f"No trained models found in {model_dir}")
+        return
+
+    for names in group_by_backbone(models):
+        model = models[names[0]]
+        device = next(model.parameters()).device
+        optimized_path = get_optimized_path(model, device)
+
+        start = time.perf_counter()
+        backbone = load_optimized_backbone(model)
+        print(f"Optimized backbone of {len(names)} model(s) ready in {time.perf_counter() - start:.1f}s")
+
+        images = torch.randint(0, 256, (batch_size, 28, 28), dtype=torch.uint8, device=device)
+        inputs = preprocess_batch(images, model.image_size)
+        eager_features, eager_time = time_backbone(model.extract_features, inputs)
+        optimized_features, optimized_time = time_backbone(backbone, inputs)
+        difference = (eager_features - optimized_features).abs().max().item()
+        print(f"Eager {batch_size / eager_time:.1f} images/sec, optimized {batch_size / optimized_time:.1f} "
+              f"images/sec, max feature difference {difference:.2e}")
+
+        print(f"Backbone of {', '.join(names)} exported to {optimized_path}")
+
+
+if __name__ == "__main__":
+    main()
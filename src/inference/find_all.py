@@ -0,0 +1,146 @@
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from src.dataset.dataset import ImageStoreTestDataset
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import preprocess_batch, stack_images
+from src.dataset.test_remove_labels import check_and_remove_label_column
+from src.inference.batching import autotune_batch_size, report_throughput
+from src.model.feature_cache import backbone_hash
+from src.model.optimize import apply_optimized_backbone
+from src.model.quantization import apply_quantized_backbone
+from src.inference.scores import output_scores
+from src.prediction_store import SCORE_DTYPE, write_prediction_store, export_prediction_json
+from src.tasks import GLOBAL_CLASSES, PROP_CLASSES, SUB_PROPS
+import src.global_classifier.find_global as find_global
+import src.props.find_prop as find_prop
+import src.sub_props.find_sub_prop as find_sub_prop
+
+
+def load_models(model_dir):
+    """Load every trained head that has a checkpoint, keyed by the name used in the output files."""
+    models = {}
+
+    global_path = os.path.join(model_dir, "global_model.pth")
+    if os.path.exists(global_path):
+        models["global"] = find_global.load_trained_model(global_path, GLOBAL_CLASSES)
+
+    for prop, n_classes in PROP_CLASSES.items():
+        model_path = os.path.join(model_dir, f"{prop}_model.pth")
+        if os.path.exists(model_path):
+            models[prop] = find_prop.load_trained_model(model_path, n_classes)
+
+    for prop, sub_props in SUB_PROPS.items():
+        for sub_prop in sub_props:
+            model_path = os.path.join(model_dir, prop, f"{sub_prop}_model.pth")
+            if os.path.exists(model_path):
+                models[f"{prop}/{sub_prop}"] = find_sub_prop.load_trained_model(model_path)
+
+    return models
+
+
+def load_data(csv_file, batch_size=64, forward=None):
+    # Raw uint8 batches, forward_groups preprocesses them for the input size of each backbone
+    dataset = ImageStoreTestDataset(ensure_image_store(csv_file))
+    if batch_size == "auto":
+        batch_size = autotune_batch_size(forward, dataset, collate_fn=stack_images)
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=stack_images)
+    return data_loader
+
+
+def group_by_backbone(models):
+    # Heads trained on the frozen ImageNet backbone all share it, so the backbone only has to run once per group
+    groups = {}
+    for name, model in models.items():
+        groups.setdefault(backbone_hash(model), []).append(name)
+    return list(groups.values())
+
+
+def forward_groups(models, groups, images):
+    """Run each distinct backbone once on a uint8 (N, 28, 28) tensor and return the outputs of every head."""
+    outputs = {}
+    for names in groups:
+        backbone = models[names[0]]
+        device = next(backbone.parameters()).device
+        features = backbone.extract_features(preprocess_batch(images.to(device), backbone.image_size))
+
+        for name in names:
+            outputs[name] = models[name].forward_head(features)
+    return outputs
+
+
+def generate_predictions(models, data_loader, groups=None):
+    if groups is None:
+        groups = group_by_backbone(models)
+    print(f"Running {len(groups)} backbone pass(es) per batch for {len(models)} heads")
+
+    predictions = {name: [] for name in models}
+    scores = {name: [] for name in models}
+
+    image_count = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for images in data_loader:
+            outputs = forward_groups(models, groups, images)
+
+            for name, model in models.items():
+                scores[name].append(output_scores(outputs[name], model.use_sigmoid))
+                if model.use_sigmoid:
+                    predictions[name].append((outputs[name] > 0.5).view(-1).cpu().numpy())
+                else:
+                    _, predicted = torch.max(outputs[name], 1)
+                    predictions[name].append(predicted.cpu().numpy())
+            image_count += len(images)
+    report_throughput("All models", image_count, time.perf_counter() - start)
+
+    predictions = {name: np.concatenate(batches) if batches else np.empty(0, dtype=np.int64)
+                   for name, batches in predictions.items()}
+    scores = {name: np.concatenate(batches) if batches else np.empty(0, dtype=SCORE_DTYPE)
+              for name, batches in scores.items()}
+    return predictions, scores
+
+
+def get_n_classes(model):
+    # Binary heads predict 0 or 1
+    return 2 if model.use_sigmoid else model.n_classes
+
+
+def main(batch_size="auto", export_json=False, quantize=False, optimize=True):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_file = os.path.join(current_dir, '../../data/csv/test.csv')
+    model_dir = os.path.join(current_dir, '../../data/model')
+    store_dir = os.path.join(current_dir, '../../data/predictions/test')
+    json_dir = os.path.join(current_dir, '../../data/json')
+
+    check_and_remove_label_column(csv_file)
+
+    models = load_models(model_dir)
+    if not models:
+        print(f"No trained models found in {model_dir}")
+        return
+
+    groups = group_by_backbone(models)
+    if quantize:
+        # int8 backbone on the CPU, calibrated on a sample of the training images
+        apply_quantized_backbone(models, groups, os.path.join(current_dir, '../../data/csv/train.csv'))
+    elif optimize:
+        # Frozen TorchScript backbone exported once per backbone weights
+        apply_optimized_backbone(models, groups)
+
+    test_loader = load_data(csv_file, batch_size, forward=lambda images: forward_groups(models, groups, images))
+    predictions, scores = generate_predictions(models, test_loader, groups)
+
+    n_classes = {name: get_n_classes(model) for name, model in models.items()}
+    write_prediction_store(store_dir, predictions, n_classes, source=os.path.relpath(csv_file, store_dir),
+                           scores=scores)
+
+    # The JSON files of find_global, find_prop and find_sub_prop, for tools that still read them
+    if export_json:
+        export_prediction_json(store_dir, json_dir, list(PROP_CLASSES))
+
+
+if __name__ == "__main__":
+    main()
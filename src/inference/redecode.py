@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+
+from src.prediction_store import open_prediction_scores, read_prediction_meta, update_prediction_columns
+
+
+CHUNK_SIZE = 65536
+
+
+def decode_scores(scores, threshold=0.5):
+    """Labels of stored scores: argmax of (N, n_classes) probabilities, threshold on (N,) positive probabilities."""
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.ndim == 1:
+        return (scores > threshold).astype(np.int64)
+    return np.argmax(scores, axis=1)
+
+
+def redecode(store_dir, threshold=0.5, thresholds=None, chunk_size=CHUNK_SIZE):
+    """
+    Decode the labels of every column of the store again from its stored scores, without running the models.
+    thresholds overrides the threshold of binary columns by name, e.g. {"body_part/feet": 0.7}.
+    Returns the number of labels that changed per column.
+    """
+    thresholds = thresholds or {}
+    meta = read_prediction_meta(store_dir)
+    scores = open_prediction_scores(store_dir)
+
+    columns, changed = {}, {}
+    for name, column_scores in scores.items():
+        previous = np.load(os.path.join(store_dir, meta["columns"][name]["file"]), mmap_mode='r')
+        labels = np.empty(len(column_scores), dtype=meta["columns"][name]["dtype"])
+
+        # Chunked so that only the labels are held in memory, the scores stay memory-mapped
+        for start in range(0, len(column_scores), chunk_size):
+            stop = start + chunk_size
+            labels[start:stop] = decode_scores(column_scores[start:stop], thresholds.get(name, threshold))
+
+        changed[name] = int(np.count_nonzero(labels != previous))
+        columns[name] = labels
+        del previous
+
+    update_prediction_columns(store_dir, columns)
+    return changed
+
+
+def main(threshold=0.5, thresholds=None):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    store_dir = os.path.join(current_dir, '../../data/predictions/test')
+
+    changed = redecode(store_dir, threshold, thresholds)
+    for name, count in changed.items():
+        print(f"{name}: {count} labels changed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+import torch
+
+from src.prediction_store import SCORE_DTYPE
+
+
+def output_scores(outputs, use_sigmoid):
+    """
+    Probabilities of a batch of model outputs as a float16 array: (N,) probabilities of the positive class for
+    the sigmoid heads, which already output them, and (N, n_classes) softmax probabilities for the others.
+    """
+    if use_sigmoid:
+        scores = outputs.view(-1)
+    else:
+        scores = torch.softmax(outputs.float(), dim=1)
+    return scores.cpu().numpy().astype(SCORE_DTYPE)
+
+
+def get_scores_path(output_file, model_name=None):
+    # global_output.json -> global_output_scores.npy, or prop_output_body_part_scores.npy with a model name
+    base = os.path.splitext(output_file)[0]
+    if model_name is not None:
+        base += f"_{model_name}"
+    return base + "_scores.npy"
+
+
+def save_scores(scores_path, scores):
+    """Save the scores of the batches next to the JSON predictions, to decode them again later."""
+    np.save(scores_path, np.concatenate(scores) if scores else np.empty(0, dtype=SCORE_DTYPE))
+    print(f"Scores saved to {scores_path}")
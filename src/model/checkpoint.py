@@ -0,0 +1,176 @@
+import os
+
+import torch
+
+from src.model.feature_cache import hash_backbone_weights
+from src.model.model import create_model
+
+
+# Weights of the single-task head, the only part of a ResNet-50 model that training changes
+HEAD_PREFIX = "resnet.fc."
+
+# Backbone state dicts already memory-mapped by this process, shared by every model restored on them
+loaded_backbones = {}
+
+
+def get_backbone_dir():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, '../../data/model/backbones')
+
+
+def get_backbone_path(backbone_id, backbone_dir=None):
+    return os.path.join(backbone_dir or get_backbone_dir(), f"{backbone_id}.pt")
+
+
+def save_backbone(model, backbone_dir=None):
+    """Write the frozen backbone weights of model once, named by their hash, and return the hash."""
+    # Hashed at every save, since training in train mode still updates the batch norm statistics of the backbone
+    backbone_id = hash_backbone_weights(model)
+    backbone_path = get_backbone_path(backbone_id, backbone_dir)
+    if not os.path.exists(backbone_path):
+        os.makedirs(os.path.dirname(backbone_path), exist_ok=True)
+        state_dict = {key: value for key, value in model.state_dict().items()
+                      if not key.startswith(model.head_prefixes)}
+        # Written under a temporary name and renamed, concurrent training jobs may save the same backbone
+        tmp_path = f"{backbone_path}.{os.getpid()}.tmp"
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, backbone_path)
+        print(f"Backbone saved to {backbone_path}")
+    return backbone_id
+
+
+def save_checkpoint(model, model_save_path, state_dict=None, backbone_dir=None):
+    """
+    Save a trained model. A model on the frozen ResNet-50 backbone is saved as its head and the hash of the
+    backbone, whose weights are written once to data/model/backbones; a native model is saved whole.
+    state_dict is the single-task state dict to save, model.state_dict() by default.
+    """
+    if state_dict is None:
+        state_dict = model.state_dict()
+    if not model.frozen_backbone:
+        torch.save(state_dict, model_save_path)
+        return
+
+    head = {key: value for key, value in state_dict.items() if key.startswith(HEAD_PREFIX)}
+    previous_id = get_checkpoint_backbone_id(model_save_path)
+    backbone_id = save_backbone(model, backbone_dir)
+    torch.save({"backbone": backbone_id, "head": head}, model_save_path)
+
+    # Training on images in train mode changes the batch norm statistics of the backbone between saves, so the
+    # backbone the overwritten checkpoint pointed to may not be used any more
+    if previous_id is not None and previous_id != backbone_id:
+        remove_unused_backbone(previous_id, backbone_dir)
+
+
+def is_head_checkpoint(checkpoint):
+    return set(checkpoint) == {"backbone", "head"}
+
+
+def get_checkpoint_backbone_id(model_path):
+    """Backbone hash of a head-only checkpoint, None for a missing, unreadable or full checkpoint."""
+    try:
+        checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    except Exception:
+        return None
+    return checkpoint["backbone"] if is_head_checkpoint(checkpoint) else None
+
+
+def remove_unused_backbone(backbone_id, backbone_dir=None):
+    """Delete the backbone file of backbone_id unless a checkpoint next to the backbone directory still uses it."""
+    backbone_dir = backbone_dir or get_backbone_dir()
+    model_dir = os.path.dirname(os.path.normpath(backbone_dir))
+    for root, _, files in os.walk(model_dir):
+        for file in files:
+            if not file.endswith('.pth'):
+                continue
+            model_path = os.path.join(root, file)
+            try:
+                checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+            except Exception:
+                # Possibly being written by a concurrent training job, keep the backbone
+                return False
+            if is_head_checkpoint(checkpoint) and checkpoint["backbone"] == backbone_id:
+                return False
+
+    backbone_path = get_backbone_path(backbone_id, backbone_dir)
+    if os.path.exists(backbone_path):
+        os.remove(backbone_path)
+        loaded_backbones.pop(backbone_id, None)
+        print(f"Removed unused backbone {backbone_path}")
+    return True
+
+
+def load_backbone(backbone_id, backbone_dir=None):
+    """The backbone state dict of backbone_id, memory-mapped from disk once per process."""
+    if backbone_id not in loaded_backbones:
+        backbone_path = get_backbone_path(backbone_id, backbone_dir)
+        if not os.path.exists(backbone_path):
+            raise FileNotFoundError(f"Missing backbone {backbone_path}, the checkpoint refers to it by hash")
+        loaded_backbones[backbone_id] = torch.load(backbone_path, map_location="cpu", mmap=True, weights_only=True)
+    return loaded_backbones[backbone_id]
+
+
+def get_checkpoint_backbone(state_dict):
+    # Only the ResNet-50 models have resnet.* weights
+    return "resnet50" if any(key.startswith("resnet.") for key in state_dict) else "native"
+
+
+def load_checkpoint(model_path, n_classes, use_sigmoid=False, device="cpu", backbone_dir=None):
+    """
+    Model of either backbone from a checkpoint saved by the train modules, in eval mode on device.
+    The architecture is built on the meta device, without the ImageNet weights or any initialization, and the
+    checkpoint tensors are assigned to it. The backbone of a head-only checkpoint comes from the memory-mapped
+    backbone file, so the models restored on the same backbone share its weights on the CPU.
+    """
+    checkpoint = torch.load(model_path, map_location="cpu", weights_only=True)
+
+    if is_head_checkpoint(checkpoint):
+        backbone = "resnet50"
+        state_dict = dict(load_backbone(checkpoint["backbone"], backbone_dir))
+        state_dict.update(checkpoint["head"])
+    else:
+        # Full state dict, from the native models or saved before head-only checkpoints
+        backbone = get_checkpoint_backbone(checkpoint)
+        state_dict = checkpoint
+
+    with torch.device("meta"):
+        model = create_model(n_classes, use_sigmoid, backbone, pretrained=False)
+    model.load_state_dict(state_dict, assign=True)
+    if is_head_checkpoint(checkpoint):
+        model.backbone_id = checkpoint["backbone"]
+
+    model.to(device)
+    model.eval()
+    return model
+
+
+def convert_checkpoint(model_path, backbone_dir=None):
+    """Rewrite a full ResNet-50 checkpoint as a head-only one. Returns False if there was nothing to convert."""
+    checkpoint = torch.load(model_path, map_location="cpu", weights_only=True)
+    if is_head_checkpoint(checkpoint) or get_checkpoint_backbone(checkpoint) != "resnet50":
+        return False
+
+    n_classes = checkpoint[HEAD_PREFIX + "weight"].shape[0]
+    model = create_model(n_classes, pretrained=False)
+    model.load_state_dict(checkpoint)
+    tmp_path = f"{model_path}.{os.getpid()}.tmp"
+    save_checkpoint(model, tmp_path, backbone_dir=backbone_dir)
+    os.replace(tmp_path, model_path)
+    return True
+
+
+def main():
+    # Convert the checkpoints saved before head-only checkpoints, which repeat the whole backbone
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    model_dir = os.path.join(current_dir, '../../data/model')
+
+    for root, _, files in os.walk(model_dir):
+        for file in sorted(files):
+            if file.endswith('_model.pth'):
+                model_path = os.path.join(root, file)
+                if convert_checkpoint(model_path):
+                    print(f"Converted {model_path} to a head-only checkpoint")
+
+
+if __name__ == "__main__":
+    main()
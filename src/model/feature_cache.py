@@ -0,0 +1,131 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, random_split
+
+from src.dataset.dataset import FeatureDataset, LabelViewDataset
+from src.dataset.image_store import ensure_image_store, open_image_store
+from src.dataset.preprocess import preprocess_batch
+from src.model.model import create_model
+
+
+FEATURE_DIM = 2048
+
+
+def get_cache_dir():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, '../../data/features')
+
+
+def backbone_hash(model):
+    """Hash of the backbone of a model, the one it was restored with if it comes from a head-only checkpoint."""
+    # Models restored from a head-only checkpoint already know the hash of the shared backbone they loaded
+    if getattr(model, 'backbone_id', None) is not None:
+        return model.backbone_id
+    return hash_backbone_weights(model)
+
+
+def hash_backbone_weights(model):
+    """Hash every backbone weight and buffer of a model, leaving out its trainable heads."""
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        if name.startswith(model.head_prefixes):
+            continue
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_cache_key(images, model):
+    digest = hashlib.sha256()
+    digest.update(str(images.shape).encode())
+    digest.update(images)
+    digest.update(backbone_hash(model).encode())
+    return digest.hexdigest()[:32]
+
+
+def extract_features(model, images, output_path, batch_size=64):
+    """Run the frozen backbone over every image once and write the features to a .npy file."""
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+
+    # Write next to the final file and rename at the end so an interrupted run never leaves a partial cache,
+    # with a name per process and thread since concurrent training jobs may extract the same features
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                         shape=(len(images), FEATURE_DIM))
+
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            batch = torch.from_numpy(np.array(images[start:start + batch_size])).to(device)
+            inputs = preprocess_batch(batch, model.image_size)
+            features[start:start + len(batch)] = model.extract_features(inputs).cpu().numpy()
+            print(f"Extracted features for {start + len(batch)}/{len(images)} images")
+
+    features.flush()
+    del features
+    os.replace(tmp_path, output_path)
+    model.train(was_training)
+
+
+def load_cached_features(model, csv_file, batch_size=64, cache_dir=None):
+    """
+    Return the backbone features of every image in csv_file as a read-only memory-mapped (N, 2048) array,
+    together with the labels of the CSV (None if it has no 'label' column).
+
+    The cache is keyed by a hash of the pixel data and of the backbone weights, so the relabeled copies
+    of train.csv and every model sharing the frozen ImageNet backbone reuse the same features.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    images, labels = open_image_store(ensure_image_store(csv_file))
+    cache_path = os.path.join(cache_dir, f"{get_cache_key(images, model)}.npy")
+
+    if os.path.exists(cache_path):
+        print(f"Using cached features {cache_path}")
+    else:
+        extract_features(model, images, cache_path, batch_size=batch_size)
+        print(f"Features saved to {cache_path}")
+
+    return np.load(cache_path, mmap_mode='r'), labels
+
+
+def load_feature_data(csv_file, model, mappings=None, validation_split=0.1):
+    """Training and validation loaders over the cached features of csv_file, relabeled with mappings if given."""
+    features, labels = load_cached_features(model, csv_file)
+
+    dataset = FeatureDataset(features, labels)
+    if mappings is not None:
+        dataset = LabelViewDataset(dataset, mappings)
+    dataset_size = len(dataset)
+    val_size = int(dataset_size * validation_split)
+    train_size = dataset_size - val_size
+    train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+
+    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
+    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False)
+    return train_loader, val_loader
+
+
+def load_test_feature_data(csv_file, model):
+    """Loader over the cached features of csv_file in file order, for the find modules."""
+    features, _ = load_cached_features(model, csv_file)
+    return DataLoader(FeatureDataset(features), batch_size=64, shuffle=False)
+
+
+def main():
+    # Features of the training images on the ImageNet backbone, extracted once before the global, prop and
+    # multi-task models train on them
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_file = os.path.join(current_dir, '../../data/csv/train.csv')
+    load_cached_features(create_model(1, use_sigmoid=True), csv_file)
+
+
+if __name__ == "__main__":
+    main()
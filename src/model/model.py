@@ -2,12 +2,26 @@ import torch
 import torch.nn as nn
 from torchvision import models
 
+from src.dataset.preprocess import IMAGE_SIZE, NATIVE_IMAGE_SIZE
+
+
+BACKBONES = ("resnet50", "native")
+
 
 class BaseCustomResNet(nn.Module):
-    def __init__(self, n_classes, use_sigmoid=False):
+    # Input resolution of preprocess_batch, whether the backbone is frozen so its features can be cached,
+    # and the state dict keys of the trainable heads
+    image_size = IMAGE_SIZE
+    frozen_backbone = True
+    head_prefixes = ("resnet.fc.",)
+
+    def __init__(self, n_classes, use_sigmoid=False, pretrained=True):
         super(BaseCustomResNet, self).__init__()
+        self.n_classes = n_classes
         self.use_sigmoid = use_sigmoid
-        resnet = models.resnet50(pretrained=True)
+        # Without pretrained the ImageNet weights are neither downloaded nor loaded, for models restored from a
+        # checkpoint that overwrites them anyway
+        resnet = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1 if pretrained else None)
 
         # Freeze all layers in the network
         for param in resnet.parameters():
@@ -19,18 +33,145 @@ class BaseCustomResNet(nn.Module):
 
         self.resnet = resnet
 
-    def forward(self, x):
-        x = self.resnet(x)
+        # When set, forward() receives the cached 2048-d backbone features instead of images
+        self.from_features = False
+
+        # Optional TorchScript module replacing the frozen backbone to extract the features, either the
+        # frozen fp32 graph of optimize.py or the int8 one of quantization.py
+        self.compiled_backbone = None
+
+    def extract_features(self, x):
+        if self.compiled_backbone is not None:
+            return self.compiled_backbone(x)
+
+        # Same steps as the torchvision ResNet forward, stopping before the fully connected layer
+        resnet = self.resnet
+        x = resnet.conv1(x)
+        x = resnet.bn1(x)
+        x = resnet.relu(x)
+        x = resnet.maxpool(x)
+
+        x = resnet.layer1(x)
+        x = resnet.layer2(x)
+        x = resnet.layer3(x)
+        x = resnet.layer4(x)
+
+        x = resnet.avgpool(x)
+        return torch.flatten(x, 1)
+
+    def forward_head(self, features):
+        x = self.resnet.fc(features)
         if self.use_sigmoid:
             return torch.sigmoid(x)
         return x
 
+    def forward(self, x):
+        if not self.from_features:
+            x = self.extract_features(x)
+        return self.forward_head(x)
+
 
 class CustomResNet(BaseCustomResNet):
-    def __init__(self):
-        super(CustomResNet, self).__init__(n_classes=1, use_sigmoid=True)
+    def __init__(self, pretrained=True):
+        super(CustomResNet, self).__init__(n_classes=1, use_sigmoid=True, pretrained=pretrained)
 
 
 class CustomMultiClassResNet(BaseCustomResNet):
-    def __init__(self, n_classes):
-        super(CustomMultiClassResNet, self).__init__(n_classes=n_classes)
+    def __init__(self, n_classes, pretrained=True):
+        super(CustomMultiClassResNet, self).__init__(n_classes=n_classes, pretrained=pretrained)
+
+
+class MultiTaskResNet(BaseCustomResNet):
+    head_prefixes = ("resnet.fc.", "heads.")
+
+    def __init__(self, tasks):
+        # tasks maps a task name, e.g. "global", "body_part" or "body_part/top_part", to its number of classes;
+        # one-class tasks are binary heads with a sigmoid, as in CustomResNet
+        super(MultiTaskResNet, self).__init__(n_classes=1)
+        num_ftrs = self.resnet.fc.in_features
+        self.resnet.fc = nn.Identity()
+
+        self.tasks = dict(tasks)
+        # Module names cannot contain "/" or "."
+        self.heads = nn.ModuleDict({self.head_key(task): nn.Linear(num_ftrs, n_classes)
+                                    for task, n_classes in self.tasks.items()})
+
+    @staticmethod
+    def head_key(task):
+        return task.replace("/", "__")
+
+    def forward_head(self, features, task):
+        x = self.heads[self.head_key(task)](features)
+        if self.tasks[task] == 1:
+            return torch.sigmoid(x)
+        return x
+
+    def forward(self, x):
+        # One backbone pass for every head
+        if not self.from_features:
+            x = self.extract_features(x)
+        return {task: self.forward_head(x, task) for task in self.tasks}
+
+    def export_task_state_dict(self, task):
+        """State dict of the single-task model of task, loadable into CustomResNet or CustomMultiClassResNet."""
+        state_dict = {key: value for key, value in self.state_dict().items() if key.startswith("resnet.")}
+        head = self.heads[self.head_key(task)]
+        state_dict["resnet.fc.weight"] = head.weight.detach().clone()
+        state_dict["resnet.fc.bias"] = head.bias.detach().clone()
+        return state_dict
+
+
+class NativeCNN(nn.Module):
+    """
+    Small CNN trained from scratch on the 28x28 images at their native resolution, with the same interface as
+    BaseCustomResNet. About 20 MFLOPs per image against about 4 GFLOPs for ResNet-50 on the upscaled images.
+    """
+    image_size = NATIVE_IMAGE_SIZE
+    frozen_backbone = False
+    head_prefixes = ("fc.",)
+
+    def __init__(self, n_classes, use_sigmoid=False):
+        super(NativeCNN, self).__init__()
+        self.n_classes = n_classes
+        self.use_sigmoid = use_sigmoid
+
+        def block(in_channels, out_channels):
+            return [nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=False),
+                    nn.BatchNorm2d(out_channels), nn.ReLU(inplace=True)]
+
+        # 28x28 -> 14x14 -> 7x7 -> 128-d features
+        self.features = nn.Sequential(
+            *block(3, 32), *block(32, 32), nn.MaxPool2d(2),
+            *block(32, 64), *block(64, 64), nn.MaxPool2d(2),
+            *block(64, 128), nn.AdaptiveAvgPool2d(1), nn.Flatten(),
+        )
+        self.dropout = nn.Dropout(0.25)
+        self.fc = nn.Linear(128, n_classes)
+
+        self.from_features = False
+        self.compiled_backbone = None
+
+    def extract_features(self, x):
+        if self.compiled_backbone is not None:
+            return self.compiled_backbone(x)
+        return self.features(x)
+
+    def forward_head(self, features):
+        x = self.fc(self.dropout(features))
+        if self.use_sigmoid:
+            return torch.sigmoid(x)
+        return x
+
+    def forward(self, x):
+        if not self.from_features:
+            x = self.extract_features(x)
+        return self.forward_head(x)
+
+
+def create_model(n_classes, use_sigmoid=False, backbone="resnet50", pretrained=True):
+    """Model of a task on one of BACKBONES; binary tasks have n_classes=1 and use_sigmoid=True."""
+    if backbone == "native":
+        return NativeCNN(n_classes, use_sigmoid)
+    if backbone == "resnet50":
+        return CustomResNet(pretrained) if use_sigmoid else CustomMultiClassResNet(n_classes, pretrained)
+    raise ValueError(f"Unknown backbone {backbone}, expected one of {BACKBONES}")
@@ -0,0 +1,93 @@
+import os
+import copy
+
+import torch
+import torch.nn as nn
+
+from src.dataset.preprocess import preprocess_batch
+from src.model.feature_cache import backbone_hash
+
+
+class BackboneFeatures(nn.Module):
+    """The extract_features of a copy of model in channels_last layout, mapping preprocessed images to features."""
+
+    def __init__(self, model):
+        super(BackboneFeatures, self).__init__()
+        self.model = copy.deepcopy(model)
+        self.model.compiled_backbone = None
+        self.model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model.extract_features(x.contiguous(memory_format=torch.channels_last))
+
+
+def get_optimized_cache_dir():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, '../../data/model/optimized')
+
+
+def get_optimized_path(model, device, cache_dir=None):
+    # The traced graph depends on the weights, the device it was optimized for and the PyTorch version
+    if cache_dir is None:
+        cache_dir = get_optimized_cache_dir()
+    version = torch.__version__.replace("+", "_")
+    return os.path.join(cache_dir, f"{backbone_hash(model)}_{device.type}_{version}.pt")
+
+
+def freeze_backbone(model, device, batch_size=8):
+    """
+    Trace the backbone of model and freeze it: weights become constants and batch norm is folded into the
+    convolutions. This is the graph saved on disk.
+    """
+    backbone = BackboneFeatures(model).to(device).eval()
+    example = preprocess_batch(torch.zeros((batch_size, 28, 28), dtype=torch.uint8, device=device), model.image_size)
+    with torch.inference_mode():
+        traced = torch.jit.trace(backbone, example)
+    return torch.jit.freeze(traced)
+
+
+def optimize_backbone(frozen, device, image_size, batch_size=8):
+    """
+    Fuse conv/relu pairs and pick the fastest kernels of the device with torch.jit.optimize_for_inference.
+    The result holds prepacked weights that cannot be serialized, so this runs on every load.
+    """
+    optimized = torch.jit.optimize_for_inference(frozen)
+
+    # The first calls run the profiling passes of the JIT, paid here rather than on the first batch
+    example = preprocess_batch(torch.zeros((batch_size, 28, 28), dtype=torch.uint8, device=device), image_size)
+    with torch.inference_mode():
+        for _ in range(2):
+            optimized(example)
+    return optimized
+
+
+def load_optimized_backbone(model, cache_dir=None):
+    """The optimized backbone of model, frozen once per backbone weights and loaded from disk afterwards."""
+    device = next(model.parameters()).device
+    optimized_path = get_optimized_path(model, device, cache_dir)
+    if os.path.exists(optimized_path):
+        frozen = torch.jit.load(optimized_path, map_location=device)
+    else:
+        os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+        frozen = freeze_backbone(model, device)
+        # Saved under a temporary name and renamed so a concurrent loader never reads a partial file
+        tmp_path = f"{optimized_path}.{os.getpid()}.tmp"
+        torch.jit.save(frozen, tmp_path)
+        os.replace(tmp_path, optimized_path)
+        print(f"Frozen backbone saved to {optimized_path}")
+    return optimize_backbone(frozen, device, model.image_size)
+
+
+def apply_optimized_backbone(models, groups, cache_dir=None):
+    """
+    Make every model of every backbone group extract its features with the group's optimized backbone.
+    Models keep their eager backbone when the export fails, whatever the error raised by tracing or freezing.
+    """
+    for names in groups:
+        try:
+            backbone = load_optimized_backbone(models[names[0]], cache_dir)
+        except Exception as e:
+            print(f"Could not optimize the backbone of {names[0]}, running it in eager mode: {e}")
+            continue
+        for name in names:
+            models[name].compiled_backbone = backbone
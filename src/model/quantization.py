@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision.models.quantization import resnet50 as quantizable_resnet50
+
+from src.dataset.image_store import ensure_image_store, open_image_store
+from src.dataset.preprocess import preprocess_batch
+from src.model.feature_cache import backbone_hash
+from src.model.model import BaseCustomResNet
+
+
+def get_quantized_engine():
+    # x86 and fbgemm are the fast server CPU kernels, qnnpack the ARM ones
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError("This build of PyTorch has no quantized CPU engine")
+
+
+def get_quantized_cache_dir():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, '../../data/model/quantized')
+
+
+def get_calibration_indices(n_total, n_images=512, seed=0):
+    # Sorted indices of the calibration sample among n_total images
+    return np.sort(np.random.default_rng(seed).choice(n_total, min(n_images, n_total), replace=False))
+
+
+def sample_calibration_images(csv_file, n_images=512, seed=0):
+    images, _ = open_image_store(ensure_image_store(csv_file))
+    return np.asarray(images[get_calibration_indices(len(images), n_images, seed)])
+
+
+def quantize_backbone(model, calibration_images, batch_size=64):
+    """
+    Static int8 copy of the frozen ResNet-50 backbone of model: the torchvision quantizable ResNet-50 with the
+    same weights, conv/bn/relu fused, observers calibrated on calibration_images and converted to int8.
+    The returned module maps preprocessed images to the 2048-d features, like model.extract_features.
+    """
+    torch.backends.quantized.engine = get_quantized_engine()
+
+    backbone = quantizable_resnet50(weights=None, quantize=False)
+    backbone.fc = nn.Identity()
+    state_dict = {key[len("resnet."):]: value for key, value in model.state_dict().items()
+                  if key.startswith("resnet.") and not key.startswith("resnet.fc.")}
+    backbone.load_state_dict(state_dict)
+    backbone.eval()
+
+    backbone.fuse_model(is_qat=False)
+    backbone.qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    torch.ao.quantization.prepare(backbone, inplace=True)
+
+    with torch.inference_mode():
+        for start in range(0, len(calibration_images), batch_size):
+            backbone(preprocess_batch(torch.from_numpy(calibration_images[start:start + batch_size])))
+
+    return torch.ao.quantization.convert(backbone, inplace=True)
+
+
+def load_quantized_backbone(model, csv_file, n_images=512, cache_dir=None):
+    """
+    The int8 backbone of model, cached as TorchScript by backbone weights and calibration size so that it is
+    calibrated only once for all the heads sharing the backbone.
+    """
+    if cache_dir is None:
+        cache_dir = get_quantized_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.backends.quantized.engine = get_quantized_engine()
+
+    cache_path = os.path.join(cache_dir, f"{backbone_hash(model)}_{n_images}_{torch.backends.quantized.engine}.pt")
+    if os.path.exists(cache_path):
+        return torch.jit.load(cache_path)
+
+    calibration_images = sample_calibration_images(csv_file, n_images)
+    backbone = quantize_backbone(model, calibration_images)
+
+    example = preprocess_batch(torch.from_numpy(calibration_images[:1]))
+    with torch.inference_mode():
+        scripted = torch.jit.trace(backbone, example)
+    torch.jit.save(scripted, cache_path)
+    print(f"Quantized backbone saved to {cache_path}")
+    return scripted
+
+
+def apply_quantized_backbone(models, groups, csv_file, n_images=512):
+    """Make every model of every ResNet-50 backbone group extract its features with the group's int8 backbone."""
+    for names in groups:
+        if not isinstance(models[names[0]], BaseCustomResNet):
+            # The small native models are already cheap and have no quantizable torchvision counterpart
+            print(f"Keeping the fp32 backbone of {', '.join(names)}")
+            continue
+        backbone = load_quantized_backbone(models[names[0]], csv_file, n_images)
+        for name in names:
+            models[name].cpu()
+            models[name].compiled_backbone = backbone
@@ -0,0 +1,89 @@
+/*
+Long-lived HermiT process used by src/ontology/reasoner_service.py, compiled on first use against the HermiT.jar
+shipped with owlready2 (which also contains the OWL API).
+
+Line protocol on stdin, one answer line per command on stdout:
+    LOAD <path>      load an ontology document, replacing the current one          -> OK
+    ADD <n>          followed by n axioms in OWL functional syntax, added            -> OK
+    REMOVE <n>       followed by n axioms in OWL functional syntax, removed          -> OK
+    CHECK            consistency of the current ontology                             -> CONSISTENT | INCONSISTENT
+    QUIT             stop the process
+Any failure is answered with "ERROR <message>".
+*/
+
+import java.io.*;
+import java.util.*;
+
+import org.semanticweb.owlapi.apibinding.OWLManager;
+import org.semanticweb.owlapi.io.StringDocumentSource;
+import org.semanticweb.owlapi.model.*;
+import org.semanticweb.HermiT.Reasoner;
+
+public class ReasonerServer {
+    private static Set<OWLAxiom> readAxioms(BufferedReader in, int count) throws Exception {
+        StringBuilder document = new StringBuilder("Ontology(\n");
+        for (int i = 0; i < count; i++) {
+            document.append(in.readLine()).append('\n');
+        }
+        document.append(")\n");
+
+        // Parse the axioms as a small anonymous ontology in a scratch manager
+        OWLOntologyManager scratch = OWLManager.createOWLOntologyManager();
+        OWLOntology delta = scratch.loadOntologyFromOntologyDocument(new StringDocumentSource(document.toString()));
+        return new HashSet<OWLAxiom>(delta.getAxioms());
+    }
+
+    public static void main(String[] args) throws Exception {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        PrintStream out = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+
+        OWLOntologyManager manager = OWLManager.createOWLOntologyManager();
+        OWLOntology ontology = null;
+        Reasoner reasoner = null;
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            try {
+                if (line.startsWith("LOAD ")) {
+                    if (ontology != null) {
+                        reasoner.dispose();
+                        manager.removeOntology(ontology);
+                    }
+                    ontology = manager.loadOntologyFromOntologyDocument(new File(line.substring(5)));
+                    reasoner = new Reasoner(ontology);
+                    out.println("OK");
+                } else if (line.startsWith("ADD ") || line.startsWith("REMOVE ")) {
+                    int count = Integer.parseInt(line.substring(line.indexOf(' ') + 1).trim());
+                    Set<OWLAxiom> axioms = readAxioms(in, count);
+                    if (ontology == null) {
+                        out.println("ERROR no ontology loaded");
+                    } else if (line.startsWith("ADD ")) {
+                        manager.addAxioms(ontology, axioms);
+                        out.println("OK");
+                    } else {
+                        manager.removeAxioms(ontology, axioms);
+                        out.println("OK");
+                    }
+                } else if (line.equals("CHECK")) {
+                    if (ontology == null) {
+                        out.println("ERROR no ontology loaded");
+                    } else {
+                        // Only the pending changes are applied, the JVM and the loaded ontology stay warm
+                        reasoner.flush();
+                        out.println(reasoner.isConsistent() ? "CONSISTENT" : "INCONSISTENT");
+                    }
+                } else if (line.equals("QUIT")) {
+                    break;
+                } else {
+                    out.println("ERROR unknown command: " + line);
+                }
+            } catch (Exception e) {
+                out.println("ERROR " + e.toString().replace('\n', ' '));
+            }
+        }
+
+        if (reasoner != null) {
+            reasoner.dispose();
+        }
+    }
+}
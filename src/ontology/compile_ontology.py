@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import owlready2 as owl
+
+
+def tbox_hash(onto):
+    """Hash of the class and property axioms of the ontology, ignoring its individuals."""
+    axioms = []
+    for entity in list(onto.classes()) + list(onto.object_properties()):
+        axioms.append(f"{entity.iri} {entity.is_a} {entity.equivalent_to}")
+        if isinstance(entity, owl.ObjectPropertyClass):
+            axioms.append(f"{entity.iri} {entity.domain} {entity.range}")
+
+    digest = hashlib.sha256()
+    for axiom in sorted(axioms):
+        digest.update(axiom.encode())
+    return digest.hexdigest()
+
+
+def get_property_families(onto):
+    """
+    Map every range class of the ExplanatoryProperty sub-properties (BodyPart, WeatherType, EdgeShape) to its
+    property and to its leaf values, e.g. {"BodyPart": {"property": "hasBodyPart", "values": [...]}}.
+    """
+    families = {}
+    for prop in onto.ExplanatoryProperty.subclasses():
+        for range_class in prop.range:
+            values = list(range_class.subclasses())
+            if any(list(value.subclasses()) for value in values):
+                raise ValueError(f"Nested values of {range_class.name} are not supported")
+            families[range_class.name] = {"property": prop.name, "values": [value.name for value in values]}
+    return families
+
+
+def collect_restrictions(construct, families, required, forbidden, negated=False):
+    # Walks a conjunction of prop.some(Value) and Not(prop.some(Value)), the only axioms used by create_ontology
+    if isinstance(construct, owl.ThingClass):
+        return
+    if isinstance(construct, owl.And) and not negated:
+        for inner in construct.Classes:
+            collect_restrictions(inner, families, required, forbidden)
+        return
+    if isinstance(construct, owl.Not) and not negated:
+        collect_restrictions(construct.Class, families, required, forbidden, negated=True)
+        return
+    if isinstance(construct, owl.Restriction) and construct.type == owl.SOME:
+        for family, info in families.items():
+            if construct.property.name == info["property"] and construct.value.name in info["values"]:
+                (forbidden if negated else required).append(construct.value.name)
+                return
+
+    raise ValueError(f"Unsupported class axiom: {construct}")
+
+
+def compile_ontology(onto):
+    """
+    Compile every Clothes subclass into the property values it requires and the ones it forbids.
+    Raises ValueError when the ontology uses axioms outside of that fragment, in which case the reasoner
+    has to be used instead.
+    """
+    families = get_property_families(onto)
+    classes = {}
+
+    for clothes_class in onto.Clothes.subclasses():
+        required, forbidden = [], []
+        for construct in list(clothes_class.is_a) + list(clothes_class.equivalent_to):
+            collect_restrictions(construct, families, required, forbidden)
+        classes[clothes_class.name] = {"required": required, "forbidden": forbidden}
+
+    return {"tbox_hash": tbox_hash(onto), "families": families, "classes": classes}
+
+
+class CompiledChecker:
+    """
+    Consistency checker over bitmasks, one bit per property value.
+
+    An image asserts prop.some(value) for its predicted value of each family and Not(prop.some(other)) for
+    every other value, so it is consistent with its class exactly when it has all the required values and
+    none of the forbidden ones.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.families = compiled["families"]
+        self.class_names = list(compiled["classes"])
+        self.class_index = {name: i for i, name in enumerate(self.class_names)}
+
+        self.bits = {}
+        for family, info in self.families.items():
+            for value in info["values"]:
+                self.bits[(family, value)] = 1 << len(self.bits)
+
+        self.required = np.zeros(len(self.class_names), dtype=np.int64)
+        self.forbidden = np.zeros(len(self.class_names), dtype=np.int64)
+        for i, name in enumerate(self.class_names):
+            for family, info in self.families.items():
+                for value in info["values"]:
+                    if value in compiled["classes"][name]["required"]:
+                        self.required[i] |= self.bits[(family, value)]
+                    if value in compiled["classes"][name]["forbidden"]:
+                        self.forbidden[i] |= self.bits[(family, value)]
+
+    def check(self, class_codes, value_masks):
+        """Vectorized check: class_codes are indices into class_names and value_masks the OR of value bits."""
+        required = self.required[class_codes]
+        forbidden = self.forbidden[class_codes]
+        return ((required & ~value_masks) == 0) & ((forbidden & value_masks) == 0)
+
+    def encode(self, json_data):
+        """Turn compound_output.json entries into class codes and value masks."""
+        class_codes = np.empty(len(json_data), dtype=np.int64)
+        value_masks = np.zeros(len(json_data), dtype=np.int64)
+
+        for i, properties in enumerate(json_data.values()):
+            clothes = properties["Clothes"]
+            if clothes not in self.class_index:
+                raise ValueError(f"Unknown Clothes class: {clothes}")
+            class_codes[i] = self.class_index[clothes]
+
+            # Values that are missing or unknown to the ontology assert nothing positive, as in the reasoner
+            for family, value in properties.get("Properties", {}).items():
+                value_masks[i] |= self.bits.get((family, value), 0)
+
+        return class_codes, value_masks
+
+    def find_inconsistent(self, json_data):
+        class_codes, value_masks = self.encode(json_data)
+        consistent = self.check(class_codes, value_masks)
+        return [image_id for image_id, ok in zip(json_data, consistent) if not ok]
+
+
+def load_compiled_checker(onto, compiled_path):
+    """Return a CompiledChecker, reusing compiled_path when it was compiled from the same TBox."""
+    current_hash = tbox_hash(onto)
+
+    if os.path.exists(compiled_path):
+        with open(compiled_path, 'r') as file:
+            compiled = json.load(file)
+        if compiled.get("tbox_hash") == current_hash:
+            return CompiledChecker(compiled)
+
+    compiled = compile_ontology(onto)
+    with open(compiled_path, 'w') as file:
+        json.dump(compiled, file, indent=4)
+    print(f"Compiled ontology saved to {compiled_path}")
+
+    return CompiledChecker(compiled)
+
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    ontology_path = os.path.join(current_dir, '../../data/ontology/ontology.owl')
+    compiled_path = os.path.join(current_dir, '../../data/ontology/compiled_ontology.json')
+
+    onto = owl.get_ontology(ontology_path).load()
+    load_compiled_checker(onto, compiled_path)
+
+
+if __name__ == '__main__':
+    main()
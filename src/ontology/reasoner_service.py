@@ -0,0 +1,113 @@
+import os
+import hashlib
+import subprocess
+import tempfile
+
+import owlready2
+import owlready2.reasoning
+
+
+SERVER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ReasonerServer.java")
+
+
+def get_hermit_classpath():
+    hermit_dir = os.path.join(os.path.dirname(owlready2.__file__), "hermit")
+    return os.path.join(hermit_dir, "HermiT.jar")
+
+
+def get_javac():
+    java_dir = os.path.dirname(owlready2.JAVA_EXE)
+    return os.path.join(java_dir, "javac") if java_dir else "javac"
+
+
+def compile_server(build_dir=None):
+    """Compile ReasonerServer.java once per version of its source and return the directory of the class file."""
+    with open(SERVER_SOURCE, 'rb') as file:
+        source_hash = hashlib.sha256(file.read()).hexdigest()[:16]
+
+    if build_dir is None:
+        build_dir = os.path.join(tempfile.gettempdir(), f"reasoner_server_{source_hash}")
+
+    if not os.path.exists(os.path.join(build_dir, "ReasonerServer.class")):
+        os.makedirs(build_dir, exist_ok=True)
+        subprocess.run([get_javac(), "-cp", get_hermit_classpath(), "-d", build_dir, SERVER_SOURCE], check=True)
+
+    return build_dir
+
+
+class ReasonerService:
+    """
+    Keeps one HermiT JVM running and talks to it over stdin/stdout (see ReasonerServer.java), so repeated
+    consistency checks only send the added or removed axioms instead of starting a JVM and re-parsing a full
+    dump of the ontology every time, as sync_reasoner() does.
+    """
+
+    def __init__(self, java_memory=None):
+        self.java_memory = java_memory or owlready2.reasoning.JAVA_MEMORY
+        self.process = None
+
+    def get_command(self):
+        classpath = os.pathsep.join([compile_server(), get_hermit_classpath()])
+        return [owlready2.JAVA_EXE, f"-Xmx{self.java_memory}M", "-cp", classpath, "ReasonerServer"]
+
+    def start(self):
+        if self.process is not None:
+            return
+        self.process = subprocess.Popen(self.get_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        encoding="utf-8", bufsize=1)
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write("QUIT\n")
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, command, lines=()):
+        self.start()
+        self.process.stdin.write(command + "\n")
+        for line in lines:
+            self.process.stdin.write(line + "\n")
+        self.process.stdin.flush()
+
+        answer = self.process.stdout.readline().strip()
+        if not answer:
+            raise RuntimeError("The reasoner service stopped unexpectedly")
+        if answer.startswith("ERROR"):
+            raise RuntimeError(f"Reasoner service error: {answer[6:]}")
+        return answer
+
+    def load(self, ontology_path):
+        self.send(f"LOAD {os.path.abspath(ontology_path)}")
+
+    def load_ontology(self, onto):
+        # The only full dump: the current state of onto becomes the base that later deltas apply to
+        with tempfile.NamedTemporaryFile(suffix=".owl", delete=False) as tmp:
+            tmp_path = tmp.name
+        try:
+            onto.save(file=tmp_path, format="rdfxml")
+            self.load(tmp_path)
+        finally:
+            os.remove(tmp_path)
+
+    def add(self, axioms):
+        axioms = list(axioms)
+        self.send(f"ADD {len(axioms)}", axioms)
+
+    def remove(self, axioms):
+        axioms = list(axioms)
+        self.send(f"REMOVE {len(axioms)}", axioms)
+
+    def is_consistent(self):
+        return self.send("CHECK") == "CONSISTENT"
@@ -0,0 +1,47 @@
+import os
+import json
+
+
+SIGNATURE_CATEGORIES = ['BodyPart', 'WeatherType', 'EdgeShape']
+
+
+def get_signature(properties):
+    """
+    The consistency of an image only depends on its Clothes class and property values,
+    e.g. "TshirtTop|TopPart|Warm|CurveEdge". Missing properties are left empty.
+    """
+    properties_present = properties.get("Properties", {})
+    values = [properties_present.get(category, "") for category in SIGNATURE_CATEGORIES]
+    return "|".join([properties["Clothes"]] + values)
+
+
+def load_verdict_cache(cache_path, ontology_hash):
+    """Return the {signature: consistent} verdicts known for this version of the ontology."""
+    if not os.path.exists(cache_path):
+        return {}
+
+    with open(cache_path, 'r') as file:
+        cache = json.load(file)
+    return cache.get(ontology_hash, {})
+
+
+def save_verdict_cache(cache_path, ontology_hash, verdicts):
+    # Verdicts of other ontology versions are kept, so switching back and forth does not reason again
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+    cache[ontology_hash] = verdicts
+
+    with open(cache_path, 'w') as file:
+        json.dump(cache, file, indent=4, sort_keys=True)
+
+
+def get_unknown_representatives(json_data, verdicts):
+    """Pick one image for every signature of json_data that has no verdict yet."""
+    representatives = {}
+    for image_id, properties in json_data.items():
+        signature = get_signature(properties)
+        if signature not in verdicts and signature not in representatives:
+            representatives[signature] = image_id
+    return representatives
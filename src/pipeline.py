@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def hash_file(file_path, known_hashes):
+    """
+    Content hash of a file, reusing the hash stored in known_hashes while its size and modification time
+    are unchanged so that large CSVs are only read again after they change.
+    """
+    stat = os.stat(file_path)
+    known = known_hashes.get(file_path)
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["sha256"]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    known_hashes[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def stage_fingerprint(stage, dependency_fingerprints, known_hashes):
+    """Hash of the stage's input files, its code files and the fingerprints of the stages it depends on."""
+    digest = hashlib.sha256(stage["name"].encode())
+    for kind in ("inputs", "code"):
+        for file_path in sorted(stage.get(kind, [])):
+            file_hash = hash_file(file_path, known_hashes) if os.path.exists(file_path) else "missing"
+            digest.update(f"{kind} {file_path} {file_hash}\n".encode())
+    for dependency in sorted(stage.get("deps", [])):
+        digest.update(f"dep {dependency} {dependency_fingerprints[dependency]}\n".encode())
+    return digest.hexdigest()
+
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {"stages": {}, "files": {}}
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+
+def save_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent=4, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def sort_stages(stages):
+    # Kahn's algorithm, so that every stage comes after the stages it depends on
+    ordered, done = [], set()
+    while len(ordered) < len(stages):
+        ready = [stage for stage in stages
+                 if stage["name"] not in done and all(dep in done for dep in stage.get("deps", []))]
+        if not ready:
+            raise ValueError("The stage graph has a cycle or an unknown dependency")
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage["name"])
+    return ordered
+
+
+def run_pipeline(stages, state_path, max_workers=2, force=()):
+    """
+    Run the stages whose fingerprint changed since their last successful run or whose outputs are missing.
+    A stage starts as soon as all the stages it depends on are done, so independent stages run concurrently.
+    Returns the names of the stages that ran.
+    """
+    stages = sort_stages(stages)
+    state = load_state(state_path)
+    known_hashes = state["files"]
+
+    fingerprints, pending, running, ran = {}, {stage["name"]: stage for stage in stages}, {}, []
+    error = None
+
+    def is_current(stage):
+        if stage["name"] in force:
+            return False
+        if state["stages"].get(stage["name"]) != fingerprints[stage["name"]]:
+            return False
+        return all(os.path.exists(output) for output in stage.get("outputs", []))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while (pending and error is None) or running:
+            for name, stage in list(pending.items()):
+                if error is not None:
+                    break
+                if not all(dep in fingerprints and dep not in running.values() for dep in stage.get("deps", [])):
+                    continue
+                # Fingerprinted only once its dependencies finished, since their outputs are its inputs
+                fingerprints[name] = stage_fingerprint(stage, fingerprints, known_hashes)
+                del pending[name]
+                if is_current(stage):
+                    print(f"Skipping {name}, up to date")
+                    continue
+                print(f"Running {name}")
+                running[executor.submit(stage["run"])] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    # Let the running stages finish and keep their state, but start nothing new
+                    print(f"Stage {name} failed: {future.exception()}")
+                    error = error or future.exception()
+                    continue
+                state["stages"][name] = fingerprints[name]
+                save_state(state_path, state)
+                ran.append(name)
+
+    if error is not None:
+        raise error
+    return ran
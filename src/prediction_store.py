@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+
+# Scores are probabilities, float16 keeps about three significant digits at a quarter of the float64 size
+SCORE_DTYPE = np.float16
+
+
+def get_column_file(name):
+    # Sub-property columns are named "prop/sub_prop"
+    return name.replace("/", ".") + ".npy"
+
+
+def get_scores_file(name):
+    return name.replace("/", ".") + ".scores.npy"
+
+
+def get_column_dtype(n_classes):
+    # Class indices of at most 256 classes fit in one byte
+    return np.min_scalar_type(max(n_classes - 1, 0))
+
+
+def write_prediction_store(store_dir, columns, n_classes, source=None, scores=None):
+    """
+    Write one typed .npy array per column, e.g. {"global": [...], "body_part": [...]}, plus a meta.json header
+    with the number of images and the classes of every column. The store is written next to store_dir and
+    renamed at the end so readers never see a partial store.
+    scores optionally holds the per-class probabilities of the columns, (N, n_classes) arrays or (N,)
+    probabilities of the positive class for binary heads, saved as float16 next to the labels.
+    """
+    scores = scores or {}
+    tmp_dir = store_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    n_images = None
+    meta_columns = {}
+    for name, values in columns.items():
+        values = np.asarray(values, dtype=get_column_dtype(n_classes[name]))
+        if n_images is None:
+            n_images = len(values)
+        elif len(values) != n_images:
+            raise ValueError(f"Column {name} has {len(values)} rows instead of {n_images}")
+
+        np.save(os.path.join(tmp_dir, get_column_file(name)), values)
+        meta_columns[name] = {"file": get_column_file(name), "dtype": values.dtype.name,
+                              "n_classes": n_classes[name]}
+
+        if name in scores:
+            np.save(os.path.join(tmp_dir, get_scores_file(name)), np.asarray(scores[name], dtype=SCORE_DTYPE))
+            meta_columns[name]["scores_file"] = get_scores_file(name)
+
+    meta = {"n_images": n_images or 0, "source": source, "columns": meta_columns}
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as file:
+        json.dump(meta, file, indent=4)
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+    print(f"Predictions saved to {store_dir}")
+
+
+def get_store_mtime(store_dir):
+    """Time of the latest write to the store in ns, None without a store. redecode swaps label files, not meta.json."""
+    if not os.path.exists(os.path.join(store_dir, "meta.json")):
+        return None
+    return max(entry.stat().st_mtime_ns for entry in os.scandir(store_dir))
+
+
+def is_newer_than_store(file_path, store_dir):
+    # A JSON file written after the store comes from a standalone find module run
+    store_mtime = get_store_mtime(store_dir)
+    return os.path.exists(file_path) and (store_mtime is None or os.stat(file_path).st_mtime_ns > store_mtime)
+
+
+def read_prediction_meta(store_dir):
+    with open(os.path.join(store_dir, "meta.json"), 'r') as file:
+        return json.load(file)
+
+
+def open_prediction_store(store_dir, names=None):
+    """Return {column: read-only memory-mapped array} for the columns of the store, or only those in names."""
+    meta = read_prediction_meta(store_dir)
+    if names is None:
+        names = list(meta["columns"])
+
+    columns = {}
+    for name in names:
+        if name not in meta["columns"]:
+            raise KeyError(f"No column {name} in {store_dir}")
+        columns[name] = np.load(os.path.join(store_dir, meta["columns"][name]["file"]), mmap_mode='r')
+    return columns
+
+
+def open_prediction_scores(store_dir, names=None):
+    """Return {column: read-only memory-mapped float16 scores} for the columns of the store that have scores."""
+    meta = read_prediction_meta(store_dir)
+    if names is None:
+        names = [name for name, column in meta["columns"].items() if "scores_file" in column]
+
+    scores = {}
+    for name in names:
+        if "scores_file" not in meta["columns"].get(name, {}):
+            raise KeyError(f"No scores for column {name} in {store_dir}")
+        scores[name] = np.load(os.path.join(store_dir, meta["columns"][name]["scores_file"]), mmap_mode='r')
+    return scores
+
+
+def update_prediction_columns(store_dir, columns):
+    """Replace the labels of existing columns, each file being swapped in atomically."""
+    meta = read_prediction_meta(store_dir)
+    for name, values in columns.items():
+        column = meta["columns"][name]
+        values = np.asarray(values, dtype=column["dtype"])
+        if len(values) != meta["n_images"]:
+            raise ValueError(f"Column {name} has {len(values)} rows instead of {meta['n_images']}")
+
+        file_path = os.path.join(store_dir, column["file"])
+        # np.save adds .npy to names that do not end with it
+        tmp_path = file_path + ".tmp.npy"
+        np.save(tmp_path, values)
+        os.replace(tmp_path, file_path)
+
+
+def write_json_file(file_path, data):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as file:
+        json.dump(data, file, indent=4)
+    print(f"Predictions saved to {file_path}")
+
+
+def export_prediction_json(store_dir, json_dir, props):
+    """
+    Export the store as the JSON files of find_global, find_prop and find_sub_prop: global_output.json,
+    prop_output.json with the columns in props, and {prop}/{sub_prop}_output.json for the sub-properties.
+    The files get the modification time of the store, so readers do not take them for newer predictions.
+    """
+    columns = open_prediction_store(store_dir)
+    file_paths = []
+
+    if "global" in columns:
+        file_paths.append(os.path.join(json_dir, "global_output.json"))
+        write_json_file(file_paths[-1], dict(enumerate(columns["global"].tolist())))
+
+    prop_columns = {prop: columns[prop].tolist() for prop in props if prop in columns}
+    if prop_columns:
+        n_images = len(next(iter(prop_columns.values())))
+        prop_predictions = {i: {prop: values[i] for prop, values in prop_columns.items()} for i in range(n_images)}
+        file_paths.append(os.path.join(json_dir, "prop_output.json"))
+        write_json_file(file_paths[-1], prop_predictions)
+
+    for name, values in columns.items():
+        if "/" in name:
+            # Sub-properties are presence flags, booleans as written by find_sub_prop
+            prop, sub_prop = name.split("/")
+            file_paths.append(os.path.join(json_dir, prop, f"{sub_prop}_output.json"))
+            write_json_file(file_paths[-1], dict(enumerate(values.astype(bool).tolist())))
+
+    store_mtime = get_store_mtime(store_dir)
+    for file_path in file_paths:
+        os.utime(file_path, ns=(store_mtime, store_mtime))
+
+
+def write_json_stream(file_path, chunks):
+    """
+    Write a JSON object from chunks of already formatted '    "key": value' entries, producing the same text as
+    json.dump(..., indent=4) without holding the whole object in memory.
+    """
+    with open(file_path, 'w') as file:
+        file.write("{")
+        first_entry = True
+        for entries in chunks:
+            for entry in entries:
+                file.write(("\n" if first_entry else ",\n") + entry)
+                first_entry = False
+        file.write("}" if first_entry else "\n}")
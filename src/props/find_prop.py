@@ -1,61 +1,76 @@
 import os
+import time
+
 import torch
 from torch.utils.data import DataLoader
-import torchvision.transforms as transforms
 from src.dataset.test_remove_labels import check_and_remove_label_column
-from src.dataset.dataset import CustomTestDataset
-from src.model.model import CustomMultiClassResNet
+from src.dataset.dataset import ImageStoreTestDataset
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import preprocess_batch, stack_images
+from src.model.checkpoint import load_checkpoint
+from src.inference.scores import get_scores_path, output_scores, save_scores
+from src.inference.batching import autotune_batch_size, report_throughput
+from src.model.feature_cache import backbone_hash, load_test_feature_data
 import json
 
 
 def load_trained_model(model_path, n_classes):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = CustomMultiClassResNet(n_classes).to(device)
-    model.load_state_dict(torch.load(model_path, map_location=device))
-    model.eval()
-    return model
-
+    return load_checkpoint(model_path, n_classes, device=device)
 
-def load_data(csv_file):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
 
-    dataset = CustomTestDataset(csv_file=csv_file, transform=transform)
-    data_loader = DataLoader(dataset, batch_size=1, shuffle=False)
+def load_data(csv_file, batch_size=64, forward=None):
+    # Raw uint8 batches, preprocessed for each model since the ResNet-50 and native models take different sizes
+    dataset = ImageStoreTestDataset(ensure_image_store(csv_file))
+    if batch_size == "auto":
+        batch_size = autotune_batch_size(forward, dataset, collate_fn=stack_images)
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=stack_images)
     return data_loader
 
 
 def generate_predictions(models, data_loader, output_file):
     predictions = {}
+    scores = {model_name: [] for model_name in models}
 
-    with torch.no_grad():
-        for i, inputs in enumerate(data_loader):
-            # Ensure there's a dictionary for this image index
-            if i not in predictions:
-                predictions[i] = {}
+    image_count = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for inputs in data_loader:
+            batch_predictions = {}
+            device_inputs = {}
 
             for model_name, model in models.items():
-                device = next(model.parameters()).device  # Ensure inputs are on the same device as the model
-                inputs = inputs.to(device)
-                outputs = model(inputs)
+                # Move and preprocess the batch only once per device and input size, every such model reuses it
+                device = next(model.parameters()).device
+                key = (device, model.image_size)
+                if key not in device_inputs:
+                    device_inputs[key] = inputs.to(device)
+                    if not model.from_features:
+                        device_inputs[key] = preprocess_batch(device_inputs[key], model.image_size)
+                outputs = model(device_inputs[key])
 
                 # Assuming each model outputs logits for classes
                 # get the predicted class index
                 _, predicted = torch.max(outputs, 1)
+                batch_predictions[model_name] = predicted.tolist()
+                scores[model_name].append(output_scores(outputs, model.use_sigmoid))
 
-                # Store the prediction using the model's name as the key
-                predictions[i][model_name] = predicted.item()
+            # Store the predictions of every image using the model's name as the key
+            for offset in range(len(inputs)):
+                predictions[image_count] = {model_name: batch_predictions[model_name][offset]
+                                            for model_name in models}
+                image_count += 1
+    report_throughput("Prop models", image_count, time.perf_counter() - start)
 
     with open(output_file, 'w') as f:
         json.dump(predictions, f, indent=4)
 
     print(f"Predictions saved to {output_file}")
+    for model_name, model_scores in scores.items():
+        save_scores(get_scores_path(output_file, model_name), model_scores)
 
 
-def main():
+def main(use_feature_cache=True, batch_size="auto"):
     current_dir = os.path.dirname(os.path.abspath(__file__))
     csv_file = os.path.join(current_dir, '../../data/csv/test.csv')
     check_and_remove_label_column(csv_file)
@@ -67,8 +82,6 @@ def main():
         "edge_shape": 2,
     }
 
-    test_loader = load_data(csv_file)
-
     models = {}
 
     for model_name in model_names:
@@ -77,6 +90,19 @@ def main():
         model_path = os.path.join(current_dir, f"../../data/model/{model_name}_model.pth")
         models[model_name] = load_trained_model(model_path, n_classes)
 
+    # Cached features can only be shared when every model has the same frozen backbone
+    if use_feature_cache and all(model.frozen_backbone for model in models.values()) and \
+            len({backbone_hash(model) for model in models.values()}) == 1:
+        test_loader = load_test_feature_data(csv_file, models[model_names[0]])
+        for model in models.values():
+            model.from_features = True
+    else:
+        def forward(inputs):
+            return [model(preprocess_batch(inputs.to(next(model.parameters()).device), model.image_size))
+                    for model in models.values()]
+
+        test_loader = load_data(csv_file, batch_size, forward=forward)
+
     output = os.path.join(current_dir, '../../data/json/prop_output.json')
     generate_predictions(models, test_loader, output)
 
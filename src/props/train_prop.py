@@ -1,28 +1,29 @@
 import os
+from functools import partial
 
 import torch
 import torch.optim as optim
-from torchvision import transforms
 from torch.utils.data import DataLoader, random_split
-from src.model.model import CustomMultiClassResNet
-from src.dataset.dataset import CustomDataset
-
-
-def load_data(csv_file, validation_split=0.1):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-
-    dataset = CustomDataset(csv_file=csv_file, transform=transform)
+from src.model.model import create_model
+from src.model.checkpoint import save_checkpoint
+from src.model.feature_cache import load_cached_features, load_feature_data
+from src.dataset.dataset import ImageStoreDataset, LabelViewDataset
+from src.dataset.relabel_dataset import PROP_MAPPINGS
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import IMAGE_SIZE, collate_images
+from src.training.scheduler import run_training_jobs
+
+
+def load_data(csv_file, mappings, validation_split=0.1, image_size=IMAGE_SIZE):
+    dataset = LabelViewDataset(ImageStoreDataset(ensure_image_store(csv_file)), mappings)
     dataset_size = len(dataset)
     val_size = int(dataset_size * validation_split)
     train_size = dataset_size - val_size
     train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
 
-    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False)
+    collate_fn = partial(collate_images, image_size=image_size)
+    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, collate_fn=collate_fn)
+    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False, collate_fn=collate_fn)
     return train_loader, val_loader
 
 
@@ -73,45 +74,60 @@ def train(model, train_loader, val_loader, optimizer, epochs, model_save_path, p
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             early_stopping_counter = 0
-            torch.save(model.state_dict(), model_save_path)
+            save_checkpoint(model, model_save_path)
         else:
             early_stopping_counter += 1
             if early_stopping_counter >= patience:
                 print(f"Early stopping triggered after {patience} epochs with no improvement")
                 break
 
+    return best_val_loss
+
 
-def main():
-    epochs = 50
-    patience = 10
+CLASSES_MAPPING = {
+    "body_part": 5,
+    "weather_type": 3,
+    "edge_shape": 2,
+}
 
+
+def train_one(prop, use_feature_cache=True, epochs=50, patience=10, backbone="resnet50"):
+    """Train the model of one property and return its best validation loss and checkpoint path."""
     current_dir = os.path.dirname(os.path.abspath(__file__))
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    classes_mapping = {
-        "body_part": 5,
-        "weather_type": 3,
-        "edge_shape": 2,
-    }
+    # Every property is trained on a label view of the same train.csv images
+    csv_file = os.path.join(current_dir, "../../data/csv/train.csv")
+    model_save_path = os.path.join(current_dir, f"../../data/model/{prop}_model.pth")
+
+    model = create_model(CLASSES_MAPPING[prop], backbone=backbone).to(device)
 
-    # Data and model setup
-    data_props = ["body_part", "weather_type", "edge_shape"]
+    if use_feature_cache and model.frozen_backbone:
+        train_loader, val_loader = load_feature_data(csv_file, model, PROP_MAPPINGS[prop])
+        model.from_features = True
+    else:
+        train_loader, val_loader = load_data(csv_file, PROP_MAPPINGS[prop], image_size=model.image_size)
 
-    models = {}
-    optimizers = {}
+    optimizer = optim.Adadelta(model.parameters())
 
-    for prop in data_props:
-        n_classes = classes_mapping[prop]
+    best_val_loss = train(model, train_loader, val_loader, optimizer, epochs, model_save_path, patience, prop)
+    return best_val_loss, model_save_path
 
-        csv_file = os.path.join(current_dir, f"../../data/csv/props/{prop}.csv")
-        model_save_path = os.path.join(current_dir, f"../../data/model/{prop}_model.pth")
 
-        train_loader, val_loader = load_data(csv_file)
+def main(use_feature_cache=True, workers=None, backbones=None):
+    # backbones picks the backbone of some properties, e.g. {"edge_shape": "native"}; the others use ResNet-50
+    backbones = backbones or {}
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_file = os.path.join(current_dir, "../../data/csv/train.csv")
+    log_dir = os.path.join(current_dir, "../../data/logs/train_prop")
 
-        models[prop] = CustomMultiClassResNet(n_classes).to(device)
-        optimizers[prop] = optim.Adadelta(models[prop].parameters())
+    if use_feature_cache and any(backbones.get(prop, "resnet50") == "resnet50" for prop in CLASSES_MAPPING):
+        # Extract the shared features once here rather than in every worker
+        load_cached_features(create_model(CLASSES_MAPPING["edge_shape"]), csv_file)
 
-        train(models[prop], train_loader, val_loader, optimizers[prop], epochs, model_save_path, patience, prop)
+    jobs = [(prop, train_one, (prop, use_feature_cache, 50, 10, backbones.get(prop, "resnet50")))
+            for prop in CLASSES_MAPPING]
+    return run_training_jobs(jobs, log_dir, workers=workers)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,12 @@ from owlready2 import *
 import os
 import json
 
+from src.explanation import build_individual_index, explanation_records, get_summary, write_explanations
+from src.ontology.compile_ontology import load_compiled_checker, tbox_hash
+from src.ontology.reasoner_service import ReasonerService
+from src.ontology.verdict_cache import get_signature, get_unknown_representatives, load_verdict_cache, \
+    save_verdict_cache
+
 def load_json_data(json_file_path):
     with open(json_file_path, 'r') as file:
         data = json.load(file)
@@ -11,124 +17,214 @@ def clean_ontology(onto):
     for individual in list(onto.individuals()):
         destroy_entity(individual)
 
-def update_ontology_with_json(json_data, onto):
-    body_parts = ['WholeBody', 'TopPart', 'BottomPart', 'Feet', 'Hands']
-    weather_types = ['Cold', 'Warm', 'Any']
-    edge_shapes = ['StraightEdge', 'CurveEdge']
 
-    all_properties = {
-        'BodyPart': body_parts,
-        'WeatherType': weather_types,
-        'EdgeShape': edge_shapes
-    }
+ALL_PROPERTIES = {
+    'BodyPart': ['WholeBody', 'TopPart', 'BottomPart', 'Feet', 'Hands'],
+    'WeatherType': ['Cold', 'Warm', 'Any'],
+    'EdgeShape': ['StraightEdge', 'CurveEdge']
+}
 
-    inconsistent_individuals = []
 
-    for image_id, properties in json_data.items():
-        clothes_class_name = properties["Clothes"]
-        properties_present = properties.get("Properties", {})
-
-        clothes_class = getattr(onto, clothes_class_name)
-        individual = clothes_class(image_id)
-
-        for prop_category, prop_list in all_properties.items():
-            predicate = getattr(onto, f'has{prop_category}')
-            if prop_category in properties_present:
-                actual_prop = properties_present[prop_category]
-                for prop in prop_list:
-                    property_class = getattr(onto, prop)
-                    if prop == actual_prop:
-                        individual.is_a.append(predicate.some(property_class))
-                    else:
-                        individual.is_a.append(Not(predicate.some(property_class)))
-            else:
-                for prop in prop_list:
-                    property_class = getattr(onto, prop)
+def add_individual(onto, image_id, properties):
+    clothes_class_name = properties["Clothes"]
+    properties_present = properties.get("Properties", {})
+
+    clothes_class = getattr(onto, clothes_class_name)
+    individual = clothes_class(image_id)
+
+    for prop_category, prop_list in ALL_PROPERTIES.items():
+        predicate = getattr(onto, f'has{prop_category}')
+        if prop_category in properties_present:
+            actual_prop = properties_present[prop_category]
+            for prop in prop_list:
+                property_class = getattr(onto, prop)
+                if prop == actual_prop:
+                    individual.is_a.append(predicate.some(property_class))
+                else:
                     individual.is_a.append(Not(predicate.some(property_class)))
+        else:
+            for prop in prop_list:
+                property_class = getattr(onto, prop)
+                individual.is_a.append(Not(predicate.some(property_class)))
+
+    return individual
+
+
+def individual_axioms(onto, image_id, properties):
+    # Same assertions as add_individual, in OWL functional syntax for the reasoner service
+    individual = f"<{onto.base_iri}{image_id}>"
+    properties_present = properties.get("Properties", {})
+
+    axioms = [f"Declaration(NamedIndividual({individual}))",
+              f"ClassAssertion(<{onto.base_iri}{properties['Clothes']}> {individual})"]
+    for prop_category, prop_list in ALL_PROPERTIES.items():
+        predicate = f"<{onto.base_iri}has{prop_category}>"
+        actual_prop = properties_present.get(prop_category)
+        for prop in prop_list:
+            restriction = f"ObjectSomeValuesFrom({predicate} <{onto.base_iri}{prop}>)"
+            if prop != actual_prop:
+                restriction = f"ObjectComplementOf({restriction})"
+            axioms.append(f"ClassAssertion({restriction} {individual})")
+
+    return axioms
+
+
+def is_consistent(onto):
+    with onto:
+        try:
+            sync_reasoner()
+            return True
+        except OwlReadyInconsistentOntologyError:
+            return False
+
+
+def add_if_consistent(onto, json_data, image_ids, stats=None, service=None):
+    """
+    Add the individuals of image_ids to the ontology and reason once, removing them again if the ontology
+    became inconsistent. With a reasoner service, only the new axioms are sent to the running reasoner.
+    Returns whether the individuals were kept.
+    """
+    if stats is not None:
+        stats["reasoner_calls"] = stats.get("reasoner_calls", 0) + 1
+
+    if service is None:
+        individuals = [add_individual(onto, image_id, json_data[image_id]) for image_id in image_ids]
+        if is_consistent(onto):
+            return True
+
+        # Remove the inconsistent group
+        for individual in individuals:
+            destroy_entity(individual)
+        return False
+
+    axioms = [axiom for image_id in image_ids for axiom in individual_axioms(onto, image_id, json_data[image_id])]
+    service.add(axioms)
+    if service.is_consistent():
+        for image_id in image_ids:
+            add_individual(onto, image_id, json_data[image_id])
+        return True
+
+    service.remove(axioms)
+    return False
+
+
+def isolate_inconsistent(onto, json_data, image_ids, known_inconsistent=False, stats=None, service=None):
+    """
+    Add the individuals of image_ids to the ontology and reason once. If the ontology is inconsistent, remove
+    them and bisect the group to find the offending images; the consistent individuals stay in the ontology.
+    Images are independent of each other, so a group is inconsistent exactly when one of its images is.
+    Returns the inconsistent image ids.
+    """
+    if not known_inconsistent and add_if_consistent(onto, json_data, image_ids, stats, service):
+        return []
+
+    if len(image_ids) == 1:
+        return list(image_ids)
+
+    middle = len(image_ids) // 2
+    left_inconsistent = isolate_inconsistent(onto, json_data, image_ids[:middle], stats=stats, service=service)
+
+    # If the left half is consistent, the offending images are all in the right half
+    right_inconsistent = isolate_inconsistent(onto, json_data, image_ids[middle:],
+                                              known_inconsistent=not left_inconsistent, stats=stats,
+                                              service=service)
+    return left_inconsistent + right_inconsistent
+
+
+def update_ontology_with_json(json_data, onto, chunk_size=64, service=None):
+    """
+    Add every image of json_data to the ontology, reasoning once per chunk of chunk_size images instead of
+    once per image. Inconsistent images are isolated by bisection, which costs about k * log2(chunk_size)
+    extra reasoner calls for k inconsistent images, and are left out of the ontology.
+    A ReasonerService, already loaded with the ontology, avoids starting a JVM for every call.
+    """
+    image_ids = list(json_data)
+    inconsistent_individuals = []
+    stats = {}
 
-        # Check consistency
-        with onto:
-            try:
-                sync_reasoner()
-            except OwlReadyInconsistentOntologyError:
-                # Remove the inconsistent individual
-                destroy_entity(individual)
-                inconsistent_individuals.append(image_id)
+    for start in range(0, len(image_ids), chunk_size):
+        chunk = image_ids[start:start + chunk_size]
+        inconsistent_individuals += isolate_inconsistent(onto, json_data, chunk, stats=stats, service=service)
 
+    print(f"Reasoned over {len(image_ids)} images with {stats.get('reasoner_calls', 0)} reasoner calls")
     return inconsistent_individuals
 
 
-def check_consistency_and_explain(onto, json_data, explanation_file, inconsistent_individuals):
-    body_parts = ['WholeBody', 'TopPart', 'BottomPart', 'Feet', 'Hands']
-    weather_types = ['Cold', 'Warm', 'Any']
-    edge_shapes = ['StraightEdge', 'CurveEdge']
+def populate_ontology(onto, json_data, inconsistent_individuals):
+    # Add the consistent images to the ontology without calling the reasoner, skipping those it already added
+    inconsistent = set(inconsistent_individuals)
+    for image_id, properties in json_data.items():
+        if image_id not in inconsistent and onto[image_id] is None:
+            add_individual(onto, image_id, properties)
+
+
+def find_inconsistent(onto, json_data, checker=None, cross_check=False, service=None):
+    """
+    Return the inconsistent images of json_data, from the compiled checker when there is one and from the
+    reasoner otherwise. The reasoner adds the consistent images to the ontology as it goes.
+    """
+    if checker is None:
+        # Update ontology with JSON data and get list of inconsistent individuals
+        return update_ontology_with_json(json_data, onto, service=service)
+
+    inconsistent_individuals = checker.find_inconsistent(json_data)
+    if cross_check:
+        reasoner_inconsistent = update_ontology_with_json(json_data, onto, service=service)
+        if set(reasoner_inconsistent) != set(inconsistent_individuals):
+            print(f"Warning: the compiled checker and the reasoner disagree on "
+                  f"{sorted(set(reasoner_inconsistent) ^ set(inconsistent_individuals))}")
+            return reasoner_inconsistent
+    return inconsistent_individuals
 
-    total_items = len(json_data)
-    inconsistent_count = len(inconsistent_individuals)
 
-    with open(explanation_file, 'w') as file:
-        first_entry = True  # Track if we're writing the first entry to avoid a newline at the start
-        for image_id, properties in json_data.items():
-            # Attempt to find the individual in the ontology
-            individual = onto.search_one(iri="*" + image_id)
+def check_consistency_and_explain(onto, json_data, explanation_file, inconsistent_individuals,
+                                  output_format="text"):
+    # One index of the individuals instead of an IRI search per image, records are written as they are built
+    index = build_individual_index(onto)
+    summary = get_summary(len(json_data), len(inconsistent_individuals))
+    records = explanation_records(index, json_data, inconsistent_individuals)
+    write_explanations(records, summary, explanation_file, output_format)
 
-            if individual is None:
-                explanation = f"{image_id} could not be found in the ontology. It may have been removed due to inconsistency."
-            else:
-                explanation = f"{image_id} is a {individual.is_a[0].name}"
-                if image_id in inconsistent_individuals:
-                    explanation += " and is NOT consistent, hence removed from the ontology."
-                else:
-                    explanation += " and is consistent in the ontology"
-
-                # Initialize the explanations for properties
-                prop_explanations = []
-
-                # Check and explain BodyPart properties
-                for prop in body_parts:
-                    if prop in properties.get("Properties", {}).get("BodyPart", ""):
-                        prop_explanations.append(f"it has {prop} in BodyPart")
-                    else:
-                        prop_explanations.append(f"does not have {prop} in BodyPart")
-
-                # Check and explain WeatherType properties
-                for prop in weather_types:
-                    if prop in properties.get("Properties", {}).get("WeatherType", ""):
-                        prop_explanations.append(f"it has {prop} in WeatherType")
-                    else:
-                        prop_explanations.append(f"does not have {prop} in WeatherType")
-
-                # Check and explain EdgeShape properties
-                for prop in edge_shapes:
-                    if prop in properties.get("Properties", {}).get("EdgeShape", ""):
-                        prop_explanations.append(f"it has {prop} in EdgeShape")
-                    else:
-                        prop_explanations.append(f"does not have {prop} in EdgeShape")
-
-                explanation += ". It " + ", ".join(prop_explanations) + "."
-
-            if first_entry:
-                # Calculate and write the percentage of inconsistent and consistent items
-                consistent_count = total_items - inconsistent_count
-                inconsistent_percentage = (inconsistent_count / total_items) * 100
-                consistent_percentage = (consistent_count / total_items) * 100
-
-                summary = (f"Summary:\nTotal Items: {total_items}\n"
-                           f"Inconsistent Items: {inconsistent_count} ({inconsistent_percentage:.2f}%)\n"
-                           f"Consistent Items: {consistent_count} ({consistent_percentage:.2f}%)\n\n")
-                file.write(summary)
-
-                file.write(explanation)
-                first_entry = False
-            else:
-                file.write("\n" + explanation)
-
-
-def main():
+
+def get_explanation_file(explanation_format="text"):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, "../explanation.jsonl" if explanation_format == "jsonl" else "../explanation.txt")
+
+
+def explain(explanation_format="text"):
+    """
+    Write the explanations of the last reasoning run again, e.g. in another format, from the ontology it saved
+    and the cached verdicts, without reasoning.
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    populated_path = os.path.join(current_dir, "../data/ontology/ontology_populated.owl")
+    verdict_cache_path = os.path.join(current_dir, "../data/ontology/verdict_cache.json")
+    json_file_path = os.path.join(current_dir, '../data/json/compound_output.json')
+
+    onto = get_ontology(populated_path).load()
+    json_data = load_json_data(json_file_path)
+    verdicts = load_verdict_cache(verdict_cache_path, tbox_hash(onto))
+
+    missing = [image_id for image_id, properties in json_data.items() if get_signature(properties) not in verdicts]
+    if missing:
+        print(f"{len(missing)} images have no cached verdict, run the reasoning first")
+        return
+
+    inconsistent_individuals = [image_id for image_id, properties in json_data.items()
+                                if not verdicts[get_signature(properties)]]
+    check_consistency_and_explain(onto, json_data, get_explanation_file(explanation_format),
+                                  inconsistent_individuals, explanation_format)
+
+
+def main(method="compiled", cross_check=False, use_reasoner_service=False, explanation_format="text"):
     current_dir = os.path.dirname(os.path.abspath(__file__))
     ontology_path = os.path.join(current_dir, "../data/ontology/ontology.owl")
+    # The individuals go to a separate file, so ontology.owl stays the output of create_ontology only
+    populated_path = os.path.join(current_dir, "../data/ontology/ontology_populated.owl")
+    compiled_path = os.path.join(current_dir, "../data/ontology/compiled_ontology.json")
+    verdict_cache_path = os.path.join(current_dir, "../data/ontology/verdict_cache.json")
     json_file_path = os.path.join(current_dir, '../data/json/compound_output.json')
-    explanation_file = os.path.join(current_dir, "../explanation.txt")
+    explanation_file = get_explanation_file(explanation_format)
 
     # Load the ontology
     onto = get_ontology(ontology_path).load()
@@ -139,14 +235,50 @@ def main():
     # Load and parse JSON data
     json_data = load_json_data(json_file_path)
 
-    # Update ontology with JSON data and get list of inconsistent individuals
-    inconsistent_individuals = update_ontology_with_json(json_data, onto)
+    # The compiled checker decides consistency from bitmasks derived from the class axioms,
+    # the reasoner is only needed when the ontology cannot be compiled or as a cross-check
+    checker = None
+    if method == "compiled":
+        try:
+            checker = load_compiled_checker(onto, compiled_path)
+        except ValueError as e:
+            print(f"Could not compile the ontology, using the reasoner instead: {e}")
+
+    # The verdict only depends on the (Clothes, BodyPart, WeatherType, EdgeShape) signature of an image,
+    # so each signature is reasoned about once per version of the class axioms and cached across runs.
+    # A cross-check starts from an empty cache so that every signature is checked again.
+    ontology_hash = tbox_hash(onto)
+    verdicts = {} if cross_check else load_verdict_cache(verdict_cache_path, ontology_hash)
+    representatives = get_unknown_representatives(json_data, verdicts)
+
+    if representatives:
+        representative_data = {image_id: json_data[image_id] for image_id in representatives.values()}
+        service = None
+        if use_reasoner_service and (checker is None or cross_check):
+            # One warm reasoner process for all the checks of this run, fed with deltas after the first load
+            service = ReasonerService()
+            service.load_ontology(onto)
+        try:
+            representative_inconsistent = set(find_inconsistent(onto, representative_data, checker, cross_check,
+                                                                service))
+        finally:
+            if service is not None:
+                service.close()
+
+        for signature, image_id in representatives.items():
+            verdicts[signature] = image_id not in representative_inconsistent
+        save_verdict_cache(verdict_cache_path, ontology_hash, verdicts)
+    print(f"{len(json_data)} images, {len(representatives)} new signatures reasoned about")
+
+    inconsistent_individuals = [image_id for image_id, properties in json_data.items()
+                                if not verdicts[get_signature(properties)]]
+    populate_ontology(onto, json_data, inconsistent_individuals)
 
     # Check consistency for each individual and write explanations
-    check_consistency_and_explain(onto, json_data, explanation_file, inconsistent_individuals)
+    check_consistency_and_explain(onto, json_data, explanation_file, inconsistent_individuals, explanation_format)
 
     # Save the updated ontology
-    onto.save(file=ontology_path, format="rdfxml")
+    onto.save(file=populated_path, format="rdfxml")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Asyncio queue in front of a batch predict function. Concurrent requests are coalesced into one batch of at
+    most max_batch_size images, waiting at most max_wait_ms after the first request of the batch, and the batch
+    runs in a worker thread so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, predict, max_batch_size=32, max_wait_ms=5.0, latency_window=1000):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.worker = None
+        # Request taken from the queue that did not fit in the previous batch
+        self.carry = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.latencies = deque(maxlen=latency_window)
+        self.batch_count = 0
+        self.image_count = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, images):
+        """Predict a (N, 28, 28) batch of images, possibly together with other requests."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((np.asarray(images, dtype=np.uint8), future, time.perf_counter()))
+        return await future
+
+    async def next_batch(self):
+        # Block for the first request, then take more until the batch is full or its deadline has passed
+        if self.carry is not None:
+            requests, self.carry = [self.carry], None
+        else:
+            requests = [await self.queue.get()]
+        size = len(requests[0][0])
+        deadline = requests[0][2] + self.max_wait
+
+        while size < self.max_batch_size:
+            if not self.queue.empty():
+                request = self.queue.get_nowait()
+            else:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if size + len(request[0]) > self.max_batch_size:
+                # Would overflow the batch, it starts the next one instead
+                self.carry = request
+                break
+            requests.append(request)
+            size += len(request[0])
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.next_batch()
+
+            # A failing request fails its batch, never the worker, which would leave every later request waiting
+            try:
+                images = np.concatenate([request[0] for request in requests])
+                results = await loop.run_in_executor(self.executor, self.predict, images)
+            except Exception as e:
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batch_count += 1
+            self.image_count += len(images)
+            done = time.perf_counter()
+            start = 0
+            for request_images, future, enqueued in requests:
+                if not future.done():
+                    future.set_result(results[start:start + len(request_images)])
+                start += len(request_images)
+                self.latencies.append(done - enqueued)
+
+    def stats(self):
+        """Queue depth, average batch fill and p50/p99 latency in milliseconds over the last requests."""
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "queue_depth": (self.queue.qsize() if self.queue is not None else 0) + (self.carry is not None),
+            "batches": self.batch_count,
+            "images": self.image_count,
+            "batch_fill": self.image_count / (self.batch_count * self.max_batch_size) if self.batch_count else 0.0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class BackgroundBatcher:
+    """Runs a MicroBatcher on an event loop in a daemon thread, for callers in ordinary threads."""
+
+    def __init__(self, predict, max_batch_size=32, max_wait_ms=5.0):
+        self.batcher = MicroBatcher(predict, max_batch_size, max_wait_ms)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.batcher.start(), self.loop).result()
+
+    def predict(self, images):
+        return asyncio.run_coroutine_threadsafe(self.batcher.submit(images), self.loop).result()
+
+    def stats(self):
+        return asyncio.run_coroutine_threadsafe(self.get_stats(), self.loop).result()
+
+    async def get_stats(self):
+        return self.batcher.stats()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.batcher.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
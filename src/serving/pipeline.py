@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import torch
+import owlready2 as owl
+
+from src.inference.find_all import PROP_CLASSES, SUB_PROPS, group_by_backbone, forward_groups, load_models
+from src.inference.scores import output_scores
+from src.compound_models import CLOTHES_NAMES, PROP_NAMES, decode
+from src.compound_sub_models import decode_families, get_family_slices
+from src.ontology.compile_ontology import load_compiled_checker
+from src.model.optimize import apply_optimized_backbone
+from src.model.quantization import apply_quantized_backbone
+
+
+class ClothesPipeline:
+    """
+    The whole find -> compound -> reason chain for images in memory, with the models and the compiled ontology
+    loaded once. predict() takes one uint8 28x28 image or a batch of them and returns, per image, its Clothes
+    class, its properties, its sub-properties and whether it is consistent with the ontology.
+    """
+
+    def __init__(self, model_dir, ontology_path, compiled_path, calibration_csv=None, optimize=True):
+        self.models = load_models(model_dir)
+        if "global" not in self.models:
+            raise ValueError(f"No global model in {model_dir}")
+        self.groups = group_by_backbone(self.models)
+        # With a calibration CSV the backbones run in int8 on the CPU, otherwise as frozen TorchScript graphs
+        if calibration_csv is not None:
+            apply_quantized_backbone(self.models, self.groups, calibration_csv)
+        elif optimize:
+            apply_optimized_backbone(self.models, self.groups)
+
+        self.props = [prop for prop in PROP_CLASSES if prop in self.models]
+        self.sub_props = {prop: sub_props for prop, sub_props in SUB_PROPS.items()
+                          if all(f"{prop}/{sub_prop}" in self.models for sub_prop in sub_props)}
+        self.sub_prop_slices = get_family_slices(self.sub_props)
+
+        # Only the class axioms are needed, the compiled checker decides consistency without a reasoner
+        self.checker = None
+        try:
+            onto = owl.get_ontology(ontology_path).load()
+            self.checker = load_compiled_checker(onto, compiled_path)
+        except ValueError as e:
+            print(f"Could not compile the ontology, consistency will not be checked: {e}")
+
+        print(f"Loaded {len(self.models)} models in {len(self.groups)} backbone group(s)")
+
+    def forward(self, images):
+        """Scores of every head for a uint8 (N, 28, 28) array."""
+        images = torch.from_numpy(np.ascontiguousarray(images, dtype=np.uint8))
+        with torch.inference_mode():
+            outputs = forward_groups(self.models, self.groups, images)
+        return {name: output_scores(outputs[name], self.models[name].use_sigmoid) for name in self.models}
+
+    def predict(self, images):
+        images = np.asarray(images, dtype=np.uint8)
+        single = images.ndim == 2
+        if single:
+            images = images[np.newaxis]
+        if images.ndim != 3 or images.shape[1:] != (28, 28):
+            raise ValueError(f"Expected 28x28 images, got an array of shape {images.shape}")
+
+        scores = self.forward(images)
+        results = [{"clothes": str(name), "properties": {}} for name in
+                   decode(np.argmax(scores["global"], axis=1), CLOTHES_NAMES)]
+
+        for prop in self.props:
+            category, names = PROP_NAMES[prop]
+            for result, name in zip(results, decode(np.argmax(scores[prop], axis=1), names)):
+                result["properties"][category] = str(name)
+
+        if self.sub_props:
+            score_matrix = np.stack([scores[f"{prop}/{sub_prop}"] for prop, sub_props in self.sub_props.items()
+                                     for sub_prop in sub_props], axis=1).astype(np.float32)
+            codes, multi_hit, no_hit = decode_families(score_matrix, self.sub_prop_slices)
+            for i, result in enumerate(results):
+                result["sub_properties"] = {prop: sub_props[codes[prop][i]] if codes[prop][i] >= 0 else None
+                                            for prop, sub_props in self.sub_props.items()}
+                result["multi_hit"] = [prop for prop in self.sub_props if multi_hit[prop][i]]
+                result["no_hit"] = [prop for prop in self.sub_props if no_hit[prop][i]]
+
+        if self.checker is not None and len(self.props) == len(PROP_CLASSES):
+            json_data = {i: {"Clothes": result["clothes"], "Properties": result["properties"]}
+                         for i, result in enumerate(results)}
+            class_codes, value_masks = self.checker.encode(json_data)
+            for result, consistent in zip(results, self.checker.check(class_codes, value_masks)):
+                result["consistent"] = bool(consistent)
+
+        return results[0] if single else results
+
+
+def load_pipeline(quantize=False):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    model_dir = os.path.join(current_dir, '../../data/model')
+    ontology_path = os.path.join(current_dir, '../../data/ontology/ontology.owl')
+    compiled_path = os.path.join(current_dir, '../../data/ontology/compiled_ontology.json')
+    calibration_csv = os.path.join(current_dir, '../../data/csv/train.csv') if quantize else None
+    return ClothesPipeline(model_dir, ontology_path, compiled_path, calibration_csv)
@@ -0,0 +1,129 @@
+import os
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from src.serving.batcher import BackgroundBatcher
+from src.serving.pipeline import load_pipeline
+
+
+IMAGE_BYTES = 28 * 28
+
+
+def check_images(images):
+    """The (N, 28, 28) uint8 batch of a request, a ValueError for any other shape or for pixels out of range."""
+    images = np.asarray(images)
+    if images.ndim != 3 or images.shape[1:] != (28, 28) or len(images) == 0:
+        raise ValueError(f"Expected one or more 28x28 images, got an array of shape {images.shape}")
+    if images.dtype == np.uint8:
+        return images
+    if images.dtype.kind not in "iuf":
+        raise ValueError("Pixels must be numbers")
+    if np.any((images < 0) | (images > 255)) or np.any(images != np.round(images)):
+        raise ValueError("Pixels must be integers between 0 and 255")
+    return images.astype(np.uint8)
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    GET /health answers {"status": "ok"}, GET /stats the queue depth, batch fill and latency of the batcher.
+    POST /predict takes either JSON, {"image": 28x28 nested list} or {"images": [...]}, or an
+    application/octet-stream body of N * 784 raw uint8 pixels, and answers {"predictions": [...]}.
+    """
+    pipeline = None
+    batcher = None
+    lock = threading.Lock()
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_images(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/octet-stream"):
+            if len(body) % IMAGE_BYTES:
+                raise ValueError(f"Raw bodies must hold a multiple of {IMAGE_BYTES} bytes")
+            return check_images(np.frombuffer(body, dtype=np.uint8).reshape(-1, 28, 28)), False
+
+        request = json.loads(body)
+        if "image" in request:
+            return check_images([request["image"]]), True
+        return check_images(request["images"]), False
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/stats" and self.batcher is not None:
+            self.send_json(200, self.batcher.stats())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            images, single = self.read_images()
+            if self.batcher is not None:
+                # Coalesced with the concurrent requests into one forward pass
+                predictions = self.batcher.predict(images)
+            else:
+                # One batch at a time through the models
+                with self.lock:
+                    predictions = self.pipeline.predict(images)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        if single:
+            self.send_json(200, {"prediction": predictions[0]})
+        else:
+            self.send_json(200, {"predictions": predictions})
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(pipeline, host="127.0.0.1", port=8000, socket_path=None, batcher=None):
+    PredictionHandler.pipeline = pipeline
+    PredictionHandler.batcher = batcher
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, PredictionHandler)
+    return ThreadingHTTPServer((host, port), PredictionHandler)
+
+
+def main(host="127.0.0.1", port=8000, socket_path=None, max_batch_size=32, max_wait_ms=5.0, quantize=False):
+    pipeline = load_pipeline(quantize)
+    # max_batch_size=1 disables micro-batching
+    batcher = BackgroundBatcher(pipeline.predict, max_batch_size, max_wait_ms) if max_batch_size > 1 else None
+    server = create_server(pipeline, host, port, socket_path, batcher)
+    print(f"Serving predictions on {socket_path or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if batcher is not None:
+            batcher.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main()
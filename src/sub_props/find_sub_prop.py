@@ -1,47 +1,56 @@
 import os
+import time
+from functools import partial
+
 import torch
 from torch.utils.data import DataLoader
-import torchvision.transforms as transforms
-from src.dataset.dataset import CustomTestDataset
-from src.model.model import CustomResNet
+from src.dataset.dataset import ImageStoreTestDataset
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import IMAGE_SIZE, collate_images
+from src.model.checkpoint import load_checkpoint
+from src.inference.scores import get_scores_path, output_scores, save_scores
+from src.inference.batching import autotune_batch_size, report_throughput
+from src.model.feature_cache import backbone_hash, load_test_feature_data
 from src.dataset.test_remove_labels import check_and_remove_label_column
 import json
 
 
 def load_trained_model(model_path):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = CustomResNet().to(device)
-    model.load_state_dict(torch.load(model_path, map_location=device))
-    model.eval()
-    return model
+    return load_checkpoint(model_path, n_classes=1, use_sigmoid=True, device=device)
 
 
-def load_data(csv_file):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-    dataset = CustomTestDataset(csv_file=csv_file, transform=transform)
-    data_loader = DataLoader(dataset, batch_size=1, shuffle=False)
+def load_data(csv_file, batch_size=64, forward=None, image_size=IMAGE_SIZE):
+    dataset = ImageStoreTestDataset(ensure_image_store(csv_file))
+    collate_fn = partial(collate_images, image_size=image_size)
+    if batch_size == "auto":
+        batch_size = autotune_batch_size(forward, dataset, collate_fn=collate_fn)
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
     return data_loader
 
 
 def generate_predictions(model, data_loader, output_file):
     predictions = {}
+    scores = []
     image_count = 0
-    with torch.no_grad():
+    device = next(model.parameters()).device
+    start = time.perf_counter()
+    with torch.inference_mode():
         for inputs in data_loader:
-            output = model(inputs)
-            predictions[image_count] = bool(output > 0.5)
-            image_count += 1
+            outputs = model(inputs.to(device))
+            scores.append(output_scores(outputs, model.use_sigmoid))
+            for presence in (outputs > 0.5).view(-1).tolist():
+                predictions[image_count] = presence
+                image_count += 1
+    report_throughput(os.path.basename(output_file), image_count, time.perf_counter() - start)
 
     with open(output_file, 'w') as file:
         json.dump(predictions, file, indent=4)
     print(f"Properties saved to {output_file}")
+    save_scores(get_scores_path(output_file), scores)
 
 
-def main():
+def main(use_feature_cache=True, batch_size="auto"):
     current_dir = os.path.dirname(os.path.abspath(__file__))
     data_props = {
         "body_part": ["whole_body", "top_part", "bottom_part", "feet", "hands"],
@@ -51,7 +60,8 @@ def main():
 
     csv_file = os.path.join(current_dir, '../../data/csv/test.csv')
     check_and_remove_label_column(csv_file)
-    data_loader = load_data(csv_file)
+    data_loaders = {}
+    feature_loaders = {}
 
     for prop, sub_props in data_props.items():
         for sub_prop in sub_props:
@@ -59,6 +69,21 @@ def main():
             output_file = os.path.join(current_dir, f"../../data/json/{prop}/{sub_prop}_output.json")
 
             model = load_trained_model(model_path)
+            if use_feature_cache and model.frozen_backbone:
+                # Hashed at most once per model, kept for the cache key, and the features loaded once per backbone
+                model.backbone_id = backbone_hash(model)
+                if model.backbone_id not in feature_loaders:
+                    feature_loaders[model.backbone_id] = load_test_feature_data(csv_file, model)
+                data_loader = feature_loaders[model.backbone_id]
+                model.from_features = True
+            else:
+                # The batch size is tuned once per architecture
+                if model.image_size not in data_loaders:
+                    device = next(model.parameters()).device
+                    data_loaders[model.image_size] = load_data(csv_file, batch_size,
+                                                               forward=lambda inputs: model(inputs.to(device)),
+                                                               image_size=model.image_size)
+                data_loader = data_loaders[model.image_size]
             generate_predictions(model, data_loader, output_file)
 
 
@@ -1,29 +1,30 @@
 import os
+from functools import partial
 
 import torch
 import torch.optim as optim
-import torchvision.transforms as transforms
 from torch.utils.data import DataLoader, random_split
 
-from src.model.model import CustomResNet
-from src.dataset.dataset import CustomDataset
+from src.model.model import create_model
+from src.model.checkpoint import save_checkpoint
+from src.model.feature_cache import load_cached_features, load_feature_data
+from src.dataset.dataset import ImageStoreDataset, LabelViewDataset
+from src.dataset.sub_property_relabel_dataset import SUB_PROP_MAPPINGS
+from src.dataset.image_store import ensure_image_store
+from src.dataset.preprocess import IMAGE_SIZE, collate_images
+from src.training.scheduler import run_training_jobs
 
 
-def load_data(csv_file, validation_split=0.1):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-
-    dataset = CustomDataset(csv_file=csv_file, transform=transform)
+def load_data(csv_file, mappings, validation_split=0.1, image_size=IMAGE_SIZE):
+    dataset = LabelViewDataset(ImageStoreDataset(ensure_image_store(csv_file)), mappings)
     dataset_size = len(dataset)
     val_size = int(dataset_size * validation_split)
     train_size = dataset_size - val_size
     train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
 
-    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False)
+    collate_fn = partial(collate_images, image_size=image_size)
+    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, collate_fn=collate_fn)
+    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False, collate_fn=collate_fn)
     return train_loader, val_loader
 
 
@@ -71,43 +72,65 @@ def train_model(model, train_loader, val_loader, optimizer, epochs, model_save_p
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             early_stopping_counter = 0
-            torch.save(model.state_dict(), model_save_path)
+            save_checkpoint(model, model_save_path)
         else:
             early_stopping_counter += 1
             if early_stopping_counter >= patience:
                 print(f"Early stopping triggered after {patience} epochs with no improvement")
                 break
 
+    return best_val_loss
+
+
+SUB_PROPS = {
+    "body_part": ["whole_body", "top_part", "bottom_part", "feet", "hands"],
+    "weather_type": ["cold", "warm", "any"],
+    "edge_shape": ["straight_edge", "curve_edge"]
+}
 
-def main():
-    epochs = 50
-    patience = 10
 
+def train_one(prop, sub_prop, use_feature_cache=True, epochs=50, patience=10, backbone="resnet50"):
+    """Train the binary model of one sub-property and return its best validation loss and checkpoint path."""
     current_dir = os.path.dirname(os.path.abspath(__file__))
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    # Data and model setup
-    data_props = {
-        "body_part": ["whole_body", "top_part", "bottom_part", "feet", "hands"],
-        "weather_type": ["cold", "warm", "any"],
-        "edge_shape": ["straight_edge", "curve_edge"]
-    }
+    # Every sub-property is trained on a label view of the same train.csv images
+    csv_file = os.path.join(current_dir, "../../data/csv/train.csv")
+    mappings = SUB_PROP_MAPPINGS[prop][sub_prop]
+    model_save_path = os.path.join(current_dir, f"../../data/model/{prop}/{sub_prop}_model.pth")
+    os.makedirs(os.path.dirname(model_save_path), exist_ok=True)
 
-    models = {}
-    optimizers = {}
+    model = create_model(1, use_sigmoid=True, backbone=backbone).to(device)
 
-    for prop, sub_props in data_props.items():
-        for sub_prop in sub_props:
-            csv_file = os.path.join(current_dir, f"../../data/csv/sub_props/{prop}/{sub_prop}.csv")
-            train_loader, val_loader = load_data(csv_file)
+    if use_feature_cache and model.frozen_backbone:
+        train_loader, val_loader = load_feature_data(csv_file, model, mappings)
+        model.from_features = True
+    else:
+        train_loader, val_loader = load_data(csv_file, mappings, image_size=model.image_size)
 
-            model_save_path = os.path.join(current_dir, f"../../data/model/{prop}/{sub_prop}_model.pth")
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
 
-            models[sub_prop] = CustomResNet().to(device)
-            optimizers[sub_prop] = optim.Adam(models[sub_prop].parameters(), lr=0.001)
+    best_val_loss = train_model(model, train_loader, val_loader, optimizer, epochs, model_save_path, patience,
+                                sub_prop)
+    return best_val_loss, model_save_path
 
-            train_model(models[sub_prop], train_loader, val_loader, optimizers[sub_prop], epochs, model_save_path,
-                        patience, sub_prop)
+
+def main(use_feature_cache=True, workers=None, backbones=None):
+    # backbones picks the backbone of some sub-properties, e.g. {"body_part/feet": "native"}; the others use ResNet-50
+    backbones = backbones or {}
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_file = os.path.join(current_dir, "../../data/csv/train.csv")
+    log_dir = os.path.join(current_dir, "../../data/logs/train_sub_prop")
+
+    tasks = [(prop, sub_prop, backbones.get(f"{prop}/{sub_prop}", "resnet50"))
+             for prop, sub_props in SUB_PROPS.items() for sub_prop in sub_props]
+    if use_feature_cache and any(backbone == "resnet50" for _, _, backbone in tasks):
+        # Extract the shared features once here rather than in every worker
+        load_cached_features(create_model(1, use_sigmoid=True), csv_file)
+
+    jobs = [(f"{prop}.{sub_prop}", train_one, (prop, sub_prop, use_feature_cache, 50, 10, backbone))
+            for prop, sub_prop, backbone in tasks]
+    return run_training_jobs(jobs, log_dir, workers=workers)
 
 
 if __name__ == "__main__":
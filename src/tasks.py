@@ -0,0 +1,37 @@
+import os
+
+
+# The heads of the pipeline, importable without torch so that main.py can describe its stages cheaply
+GLOBAL_CLASSES = 10
+
+PROP_CLASSES = {
+    "body_part": 5,
+    "weather_type": 3,
+    "edge_shape": 2,
+}
+
+SUB_PROPS = {
+    "body_part": ["whole_body", "top_part", "bottom_part", "feet", "hands"],
+    "weather_type": ["cold", "warm", "any"],
+    "edge_shape": ["straight_edge", "curve_edge"]
+}
+
+
+def get_tasks():
+    """Every head of the pipeline with its number of classes, in the order the single-task scripts train them."""
+    tasks = {"global": GLOBAL_CLASSES}
+    tasks.update(PROP_CLASSES)
+    for prop, sub_props in SUB_PROPS.items():
+        for sub_prop in sub_props:
+            tasks[f"{prop}/{sub_prop}"] = 1
+    return tasks
+
+
+def get_checkpoint_path(model_dir, task):
+    # Same files as train_global, train_prop and train_sub_prop, so the find scripts load them unchanged
+    if task == "global":
+        return os.path.join(model_dir, "global_model.pth")
+    if "/" in task:
+        prop, sub_prop = task.split("/")
+        return os.path.join(model_dir, prop, f"{sub_prop}_model.pth")
+    return os.path.join(model_dir, f"{task}_model.pth")
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import tempfile
+
+import numpy as np
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader, Subset
+
+from src.dataset.dataset import FeatureDataset
+from src.dataset.image_store import ensure_image_store, open_image_store
+from src.dataset.preprocess import preprocess_batch
+from src.dataset.relabel_dataset import PROP_MAPPINGS, build_label_lookup
+from src.dataset.sub_property_relabel_dataset import SUB_PROP_MAPPINGS
+from src.model.model import BACKBONES, create_model
+from src.model.checkpoint import load_checkpoint
+import src.global_classifier.train_global as train_global
+import src.props.train_prop as train_prop
+import src.sub_props.train_sub_prop as train_sub_prop
+
+
+# One task of each kind, with its number of classes and the mappings of its labels (None for the global labels)
+TASKS = {
+    "global": (10, None),
+    "body_part": (5, PROP_MAPPINGS["body_part"]),
+    "body_part/top_part": (1, SUB_PROP_MAPPINGS["body_part"]["top_part"]),
+}
+
+
+def split_indices(n_images, n_train, n_test, validation_split=0.1, seed=0):
+    indices = np.random.default_rng(seed).permutation(n_images)
+    n_train = min(n_train, n_images - n_test)
+    n_val = int(n_train * validation_split)
+    return indices[:n_train - n_val], indices[n_train - n_val:n_train], indices[n_train:n_train + n_test]
+
+
+def get_inputs(model, images, batch_size=64):
+    """What model trains on: backbone features for a frozen backbone, preprocessed images otherwise."""
+    device = next(model.parameters()).device
+    # In eval mode, as in feature_cache.extract_features, so the batch norm layers use and keep their running
+    # statistics and the features are the ones the pipeline caches
+    was_training = model.training
+    model.eval()
+    inputs = []
+    with torch.inference_mode():
+        for start in range(0, len(images), batch_size):
+            batch = preprocess_batch(torch.from_numpy(images[start:start + batch_size]).to(device), model.image_size)
+            if model.frozen_backbone:
+                batch = model.extract_features(batch)
+            inputs.append(batch.cpu().numpy())
+    model.train(was_training)
+    return np.concatenate(inputs)
+
+
+def train_task(task, model, train_loader, val_loader, model_save_path, epochs, patience):
+    # Same optimizer and training loop as the train module of the task
+    if task == "global":
+        optimizer = optim.Adadelta(model.parameters())
+        return train_global.train(model, train_loader, val_loader, optimizer, epochs, model_save_path, patience)
+    if "/" in task:
+        optimizer = optim.Adam(model.parameters(), lr=0.001)
+        return train_sub_prop.train_model(model, train_loader, val_loader, optimizer, epochs, model_save_path,
+                                          patience, task)
+    optimizer = optim.Adadelta(model.parameters())
+    return train_prop.train(model, train_loader, val_loader, optimizer, epochs, model_save_path, patience, task)
+
+
+def get_accuracy(model, inputs, labels, batch_size=256):
+    device = next(model.parameters()).device
+    correct = 0
+    with torch.inference_mode():
+        for start in range(0, len(inputs), batch_size):
+            outputs = model(torch.from_numpy(inputs[start:start + batch_size]).to(device))
+            if model.use_sigmoid:
+                predicted = (outputs > 0.5).view(-1).long()
+            else:
+                predicted = outputs.argmax(dim=1)
+            correct += (predicted.cpu().numpy() == labels[start:start + batch_size]).sum()
+    return float(correct / len(inputs))
+
+
+def get_throughput(model, images, batch_size=64):
+    """Images/sec of model from uint8 images, preprocessing included, as in the find modules."""
+    device = next(model.parameters()).device
+    from_features, model.from_features = model.from_features, False
+    with torch.inference_mode():
+        model(preprocess_batch(torch.from_numpy(images[:batch_size]).to(device), model.image_size))  # Warm-up
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for batch_start in range(0, len(images), batch_size):
+            batch = torch.from_numpy(images[batch_start:batch_start + batch_size]).to(device)
+            model(preprocess_batch(batch, model.image_size))
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    model.from_features = from_features
+    return len(images) / elapsed
+
+
+def main(n_train=10000, n_test=2000, epochs=10, patience=3, backbones=BACKBONES, tasks=TASKS):
+    """
+    Train every task of tasks on each backbone from a sample of train.csv, then compare the accuracy on
+    held-out train images (test.csv has no labels) and the images/sec of the trained models.
+    The results go to data/logs/backbone_benchmark.json.
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_file = os.path.join(current_dir, '../../data/csv/train.csv')
+    report_path = os.path.join(current_dir, '../../data/logs/backbone_benchmark.json')
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    images, labels = open_image_store(ensure_image_store(csv_file))
+    train_indices, val_indices, test_indices = split_indices(len(images), n_train, n_test)
+    # Only the sampled images are loaded, in split order
+    sample = np.concatenate([train_indices, val_indices, test_indices])
+    images, labels = np.asarray(images[sample]), np.asarray(labels[sample])
+    n_train, n_val = len(train_indices), len(val_indices)
+    train_indices, val_indices = np.arange(n_train), np.arange(n_train, n_train + n_val)
+    test_indices = np.arange(n_train + n_val, len(images))
+
+    report = {"device": device.type, "train_images": len(train_indices), "test_images": len(test_indices),
+              "results": {}}
+    with tempfile.TemporaryDirectory() as model_dir:
+        for backbone in backbones:
+            # The ResNet-50 features are shared by every task, the native models train on the images
+            inputs = get_inputs(create_model(1, backbone=backbone).to(device), images)
+
+            for task, (n_classes, mappings) in tasks.items():
+                model = create_model(n_classes, use_sigmoid=n_classes == 1, backbone=backbone).to(device)
+                model.from_features = model.frozen_backbone
+                task_labels = labels if mappings is None else build_label_lookup(mappings)[labels]
+
+                dataset = FeatureDataset(inputs, task_labels)
+                train_loader = DataLoader(Subset(dataset, train_indices), batch_size=64, shuffle=True)
+                val_loader = DataLoader(Subset(dataset, val_indices), batch_size=64, shuffle=False)
+
+                model_save_path = os.path.join(model_dir, f"{backbone}_{task.replace('/', '.')}.pth")
+                start = time.perf_counter()
+                train_task(task, model, train_loader, val_loader, model_save_path, epochs, patience)
+                train_time = time.perf_counter() - start
+
+                model = load_checkpoint(model_save_path, n_classes, n_classes == 1, device)
+                model.from_features = model.frozen_backbone
+                result = {
+                    "accuracy": get_accuracy(model, inputs[test_indices], task_labels[test_indices]),
+                    "images_per_sec": get_throughput(model, images[test_indices]),
+                    "train_seconds": train_time,
+                    "parameters": sum(parameter.numel() for parameter in model.parameters()),
+                }
+                report["results"].setdefault(task, {})[backbone] = result
+                print(f"{task} on {backbone}: accuracy {result['accuracy']:.4f}, "
+                      f"{result['images_per_sec']:.1f} images/sec")
+
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"Benchmark saved to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
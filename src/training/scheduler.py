@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+
+# Rough peak resident memory of one training job: a ResNet-50 with its optimizer state and a few batches
+JOB_MEMORY_MB = 1024
+
+
+def get_available_memory_mb():
+    # MemAvailable counts the page cache that can be reclaimed, unlike the free pages reported by sysconf
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def plan_workers(n_jobs, workers=None, memory_budget_mb=None, job_memory_mb=JOB_MEMORY_MB):
+    """
+    Return (workers, threads_per_worker). Without an explicit number of workers, use as many as the cores
+    and the memory budget allow, at most one per job, and split the cores evenly between them.
+    """
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+    if workers is None:
+        workers = min(n_jobs, n_cores)
+        if torch.cuda.is_available():
+            # The jobs would compete for the same GPU
+            workers = 1
+
+    if memory_budget_mb is None:
+        memory_budget_mb = get_available_memory_mb()
+    if memory_budget_mb is not None:
+        workers = min(workers, max(1, memory_budget_mb // job_memory_mb))
+
+    workers = max(1, min(workers, n_jobs))
+    return workers, max(1, n_cores // workers)
+
+
+def init_worker(threads_per_worker):
+    # Each worker gets its own slice of the cores instead of every process starting one thread per core
+    torch.set_num_threads(threads_per_worker)
+
+
+def run_job(name, function, args, log_path):
+    """Run function(*args) logging to log_path and return (best_val_loss, checkpoint, elapsed seconds)."""
+    start = time.perf_counter()
+    with open(log_path, 'w', buffering=1) as log_file:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = log_file
+        try:
+            print(f"Job {name}, {torch.get_num_threads()} threads")
+            best_val_loss, checkpoint = function(*args)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+    return best_val_loss, checkpoint, time.perf_counter() - start
+
+
+def run_training_jobs(jobs, log_dir, workers=None, memory_budget_mb=None, job_memory_mb=JOB_MEMORY_MB):
+    """
+    Run the training jobs, a list of (name, function, args) where function is a module-level function that
+    trains one model and returns its best validation loss and the path of its best checkpoint, in a process pool.
+    Every job logs to log_dir/<name>.log, and the results are written to log_dir/training_summary.json.
+    A failed job does not stop the others; once they are all done, a RuntimeError names the failed jobs.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    workers, threads_per_worker = plan_workers(len(jobs), workers, memory_budget_mb, job_memory_mb)
+    print(f"Training {len(jobs)} models with {workers} workers of {threads_per_worker} threads")
+
+    results = {}
+    # Spawned workers do not inherit the parent's OpenMP thread pool, which does not survive a fork
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(threads_per_worker,)) as executor:
+        futures = {}
+        for name, function, args in jobs:
+            log_path = os.path.join(log_dir, f"{name}.log")
+            futures[executor.submit(run_job, name, function, args, log_path)] = (name, log_path)
+
+        for future in as_completed(futures):
+            name, log_path = futures[future]
+            try:
+                best_val_loss, checkpoint, elapsed = future.result()
+                results[name] = {"best_val_loss": best_val_loss, "checkpoint": checkpoint, "seconds": elapsed,
+                                 "log": log_path}
+                print(f"{name}: best validation loss {best_val_loss:.4f} in {elapsed:.1f}s")
+            except Exception as e:
+                results[name] = {"error": str(e), "log": log_path}
+                print(f"{name} failed, see {log_path}: {e}")
+
+    with open(os.path.join(log_dir, "training_summary.json"), 'w') as file:
+        json.dump(results, file, indent=4, sort_keys=True)
+
+    failed = sorted(name for name, result in results.items() if "error" in result)
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(jobs)} training jobs failed: {', '.join(failed)}, see {log_dir}")
+
+    return results
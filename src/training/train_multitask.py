@@ -0,0 +1,135 @@
+import os
+
+import torch
+import torch.optim as optim
+from src.model.model import MultiTaskResNet
+from src.model.checkpoint import save_checkpoint
+from src.model.feature_cache import load_feature_data
+from src.dataset.relabel_dataset import PROP_MAPPINGS, build_label_lookup
+from src.dataset.sub_property_relabel_dataset import SUB_PROP_MAPPINGS
+from src.tasks import GLOBAL_CLASSES, get_checkpoint_path, get_tasks
+import src.global_classifier.train_global as train_global
+
+
+def get_label_lookups(tasks):
+    # Each task's labels are derived from the global label with the same mappings as the single-task scripts
+    lookups = {}
+    for task in tasks:
+        if task == "global":
+            lookups[task] = torch.arange(GLOBAL_CLASSES)
+        elif "/" in task:
+            prop, sub_prop = task.split("/")
+            lookups[task] = torch.from_numpy(build_label_lookup(SUB_PROP_MAPPINGS[prop][sub_prop]))
+        else:
+            lookups[task] = torch.from_numpy(build_label_lookup(PROP_MAPPINGS[task]))
+    return lookups
+
+
+def task_loss(model, task, outputs, labels):
+    if model.tasks[task] == 1:
+        return torch.nn.BCELoss()(outputs, labels.float().unsqueeze(1))
+    return torch.nn.CrossEntropyLoss()(outputs, labels.long())
+
+
+def create_optimizers(model):
+    # Same optimizers as the single-task scripts: Adadelta for the global and prop heads, Adam for the binary ones
+    optimizers = {}
+    for task, n_classes in model.tasks.items():
+        head = model.heads[model.head_key(task)]
+        if n_classes == 1:
+            optimizers[task] = optim.Adam(head.parameters(), lr=0.001)
+        else:
+            optimizers[task] = optim.Adadelta(head.parameters())
+    return optimizers
+
+
+def train(model, train_loader, val_loader, optimizers, epochs, model_dir, patience):
+    """
+    Train every head on the same batches, the backbone running once per batch. Each head has its own early
+    stopping: it is saved as a single-task checkpoint whenever its validation loss improves and stops training
+    after patience epochs without improvement. Returns the best validation loss of every task.
+    """
+    device = next(model.parameters()).device
+    lookups = {task: lookup.to(device) for task, lookup in get_label_lookups(model.tasks).items()}
+
+    best_val_loss = {task: float('inf') for task in model.tasks}
+    early_stopping_counter = {task: 0 for task in model.tasks}
+    active = list(model.tasks)
+
+    for epoch in range(epochs):
+        model.train()
+        total_loss = {task: 0.0 for task in active}
+        for inputs, labels in train_loader:
+            inputs, labels = inputs.to(device), labels.to(device)
+            outputs = model(inputs)
+
+            loss = 0
+            for task in active:
+                optimizers[task].zero_grad()
+                task_loss_value = task_loss(model, task, outputs[task], lookups[task][labels])
+                total_loss[task] += task_loss_value.item()
+                loss = loss + task_loss_value
+            # The heads do not share trainable parameters, so the summed loss gives each head its own gradient
+            loss.backward()
+            for task in active:
+                optimizers[task].step()
+
+        # Validation
+        model.eval()
+        val_loss = {task: 0.0 for task in active}
+        with torch.no_grad():
+            for inputs, labels in val_loader:
+                inputs, labels = inputs.to(device), labels.to(device)
+                outputs = model(inputs)
+                for task in active:
+                    val_loss[task] += task_loss(model, task, outputs[task], lookups[task][labels]).item()
+
+        for task in list(active):
+            avg_train_loss = total_loss[task] / len(train_loader)
+            avg_val_loss = val_loss[task] / len(val_loader)
+            print(f"{task} Training - Epoch [{epoch + 1}/{epochs}], "
+                  f"Training Loss: {avg_train_loss}, Validation Loss: {avg_val_loss}")
+
+            # Early Stopping, per head
+            if avg_val_loss < best_val_loss[task]:
+                best_val_loss[task] = avg_val_loss
+                early_stopping_counter[task] = 0
+                checkpoint_path = get_checkpoint_path(model_dir, task)
+                os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+                save_checkpoint(model, checkpoint_path, model.export_task_state_dict(task))
+            else:
+                early_stopping_counter[task] += 1
+                if early_stopping_counter[task] >= patience:
+                    print(f"{task}: early stopping triggered after {patience} epochs with no improvement")
+                    active.remove(task)
+
+        if not active:
+            break
+
+    return best_val_loss
+
+
+def main(use_feature_cache=True):
+    epochs = 50
+    patience = 10
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_file = os.path.join(current_dir, '../../data/csv/train.csv')
+    model_dir = os.path.join(current_dir, '../../data/model')
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = MultiTaskResNet(get_tasks()).to(device)
+
+    # The global labels of train.csv, every other task's labels are derived from them batch by batch
+    if use_feature_cache:
+        train_loader, val_loader = load_feature_data(csv_file, model)
+        model.from_features = True
+    else:
+        train_loader, val_loader = train_global.load_data(csv_file)
+
+    optimizers = create_optimizers(model)
+    return train(model, train_loader, val_loader, optimizers, epochs, model_dir, patience)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import sys
+
+import pytest
+from owlready2 import ObjectProperty, Thing, World
+
+from src.reasoning import ALL_PROPERTIES, add_if_consistent, individual_axioms
+from src.ontology.reasoner_service import ReasonerService
+
+
+# Stand-in for ReasonerServer.java speaking the same line protocol. It keeps the axioms it was sent and answers
+# INCONSISTENT when one of them asserts owl:Nothing. COUNT, which the Java server does not have, reports how
+# many axioms it holds.
+STUB_SERVER = '''
+import sys
+
+axioms = set()
+loaded = False
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if line.startswith("LOAD "):
+        axioms.clear()
+        loaded = True
+        print("OK", flush=True)
+    elif line.startswith("ADD ") or line.startswith("REMOVE "):
+        lines = [sys.stdin.readline().rstrip("\\n") for _ in range(int(line.split()[1]))]
+        if not loaded:
+            print("ERROR no ontology loaded", flush=True)
+        elif line.startswith("ADD "):
+            axioms.update(lines)
+            print("OK", flush=True)
+        else:
+            axioms.difference_update(lines)
+            print("OK", flush=True)
+    elif line == "CHECK":
+        print("INCONSISTENT" if any("#Nothing>" in axiom for axiom in axioms) else "CONSISTENT", flush=True)
+    elif line == "COUNT":
+        print(len(axioms), flush=True)
+    elif line == "QUIT":
+        break
+    elif line == "CRASH":
+        sys.exit(1)
+    else:
+        print("ERROR unknown command: " + line, flush=True)
+'''
+
+
+class StubReasonerService(ReasonerService):
+    def __init__(self, stub_path):
+        super(StubReasonerService, self).__init__(java_memory=1)
+        self.stub_path = stub_path
+
+    def get_command(self):
+        return [sys.executable, self.stub_path]
+
+
+@pytest.fixture
+def service(tmp_path):
+    stub_path = tmp_path / "stub_server.py"
+    stub_path.write_text(STUB_SERVER)
+    with StubReasonerService(str(stub_path)) as service:
+        yield service
+
+
+@pytest.fixture
+def onto():
+    # Just the classes and properties add_individual needs, in a world of its own
+    onto = World().get_ontology("http://example.org/ontology#")
+    with onto:
+        class Clothes(Thing):
+            pass
+
+        class Shirt(Clothes):
+            pass
+
+        for category, props in ALL_PROPERTIES.items():
+            category_class = type(category, (Thing,), {})
+            type(f"has{category}", (ObjectProperty,), {"domain": [Clothes], "range": [category_class]})
+            for prop in props:
+                type(prop, (category_class,), {})
+    return onto
+
+
+def test_add_check_remove(service):
+    service.load("ontology.owl")
+    service.add(["Declaration(NamedIndividual(<#a>))", "ClassAssertion(<#Shirt> <#a>)"])
+    assert service.is_consistent()
+
+    # Multi-line payloads are framed by their count, so the commands that follow are read as commands
+    service.add(["ClassAssertion(<#Nothing> <#a>)"])
+    assert not service.is_consistent()
+    service.remove(["ClassAssertion(<#Nothing> <#a>)"])
+    assert service.is_consistent()
+    assert service.send("COUNT") == "2"
+
+
+def test_empty_delta(service):
+    service.load("ontology.owl")
+    service.add([])
+    assert service.is_consistent()
+
+
+def test_error_answer_raises(service):
+    with pytest.raises(RuntimeError, match="no ontology loaded"):
+        service.add(["ClassAssertion(<#Shirt> <#a>)"])
+
+    # The service is still usable after an error
+    service.load("ontology.owl")
+    assert service.is_consistent()
+
+
+def test_stopped_process_raises(service):
+    with pytest.raises(RuntimeError, match="stopped unexpectedly"):
+        service.send("CRASH")
+
+
+def test_add_if_consistent_keeps_consistent_individuals(service, onto):
+    service.load("ontology.owl")
+    json_data = {"0": {"Clothes": "Shirt", "Properties": {"BodyPart": "TopPart", "WeatherType": "Any",
+                                                          "EdgeShape": "CurveEdge"}}}
+
+    assert add_if_consistent(onto, json_data, ["0"], service=service)
+    assert service.send("COUNT") == str(len(individual_axioms(onto, "0", json_data["0"])))
+    assert [individual.name for individual in onto.individuals()] == ["0"]
+
+
+def test_add_if_consistent_removes_inconsistent_delta(service, onto):
+    service.load("ontology.owl")
+    json_data = {"0": {"Clothes": "Nothing", "Properties": {}}}
+    stats = {}
+
+    assert not add_if_consistent(onto, json_data, ["0"], stats=stats, service=service)
+    # The removal sends back exactly the axioms that were added
+    assert service.send("COUNT") == "0"
+    assert list(onto.individuals()) == []
+    assert stats["reasoner_calls"] == 1